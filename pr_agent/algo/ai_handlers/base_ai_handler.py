@@ -16,7 +16,8 @@ class BaseAiHandler(ABC):
         pass
 
     @abstractmethod
-    async def chat_completion(self, model: str, system: str, user: str, temperature: float = 0.2, img_path: str = None):
+    async def chat_completion(self, model: str, system: str, user: str, temperature: float = 0.2, img_path: str = None,
+                              user_cache_prefix_len: int = None):
         """
         This method should be implemented to return a chat completion from the AI model.
         Args:
@@ -24,5 +25,7 @@ class BaseAiHandler(ABC):
             system (str): the system message string to use for the chat completion
             user (str): the user message string to use for the chat completion
             temperature (float): the temperature to use for the chat completion
+            user_cache_prefix_len (int): length of a prefix of the user message that may be marked for prompt caching.
+                                         A hint only, handlers that don't support prompt caching ignore it
         """
         pass
@@ -256,7 +256,10 @@ class LiteLLMAIHandler(BaseAiHandler):
         retry=retry_if_exception_type((openai.APIError, openai.APIConnectionError, openai.APITimeoutError)), # No retry on RateLimitError
         stop=stop_after_attempt(OPENAI_RETRIES)
     )
-    async def chat_completion(self, model: str, system: str, user: str, temperature: float = 0.2, img_path: str = None):
+    async def chat_completion(self, model: str, system: str, user: str, temperature: float = 0.2, img_path: str = None,
+                              user_cache_prefix_len: int = None):
+        # user_cache_prefix_len: If given, for Claude models the first user_cache_prefix_len characters of the user prompt
+        # are sent as a separate block, marked for prompt caching, so repeated prompts sharing that prefix are cheaper.
         try:
             resp, finish_reason = None, None
             deployment_id = self.deployment_id
@@ -267,6 +270,10 @@ class LiteLLMAIHandler(BaseAiHandler):
                 get_logger().warning(
                     "Empty system prompt for claude model. Adding a newline character to prevent OpenAI API error.")
             messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
+            if user_cache_prefix_len and 'claude' in model and not img_path:
+                messages[1]["content"] = [{"type": "text", "text": user[:user_cache_prefix_len],
+                                           "cache_control": {"type": "ephemeral"}},
+                                          {"type": "text", "text": user[user_cache_prefix_len:]}]
 
             if img_path:
                 try:
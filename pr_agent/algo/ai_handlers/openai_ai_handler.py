@@ -40,7 +40,9 @@ class OpenAIHandler(BaseAiHandler):
 
     @retry(exceptions=(APIError, Timeout, AttributeError, RateLimitError),
            tries=OPENAI_RETRIES, delay=2, backoff=2, jitter=(1, 3))
-    async def chat_completion(self, model: str, system: str, user: str, temperature: float = 0.2):
+    async def chat_completion(self, model: str, system: str, user: str, temperature: float = 0.2,
+                              user_cache_prefix_len: int = None):
+        # user_cache_prefix_len is ignored, as prompt caching markers are not supported by this handler
         try:
             get_logger().info("System: ", system)
             get_logger().info("User: ", user)
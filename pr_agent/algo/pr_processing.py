@@ -26,6 +26,7 @@ ADDED_FILES_ = "Additional added files (insufficient token budget to process):\n
 OUTPUT_BUFFER_TOKENS_SOFT_THRESHOLD = 1500
 OUTPUT_BUFFER_TOKENS_HARD_THRESHOLD = 1000
 MAX_EXTRA_LINES = 10
+MULTI_DIFF_COUNT_BATCH_SIZE = 32  # get_pr_multi_diffs prepares and counts the patches of this many files at a time
 
 
 def cap_and_log_extra_lines(value, direction) -> int:
@@ -171,7 +172,7 @@ def pr_generate_extended_diff(pr_languages: list,
                               patch_extra_lines_after: int = 0) -> Tuple[list, int, list]:
     total_tokens = token_handler.prompt_tokens  # initial tokens
     patches_extended = []
-    patches_extended_tokens = []
+    patches_extended_files = []
     for lang in pr_languages:
         for file in lang['files']:
             original_file_content_str = file.base_file
@@ -198,11 +199,14 @@ def pr_generate_extended_diff(pr_languages: list,
             if file.ai_file_summary and get_settings().get("config.enable_ai_metadata", False):
                 full_extended_patch = add_ai_summary_top_patch(file, full_extended_patch)
 
-            patch_tokens = token_handler.count_tokens(full_extended_patch)
-            file.tokens = patch_tokens
-            total_tokens += patch_tokens
-            patches_extended_tokens.append(patch_tokens)
             patches_extended.append(full_extended_patch)
+            patches_extended_files.append(file)
+
+    # count the tokens of all the extended patches in a single batched call
+    patches_extended_tokens = list(token_handler.count_many(patches_extended))
+    for file, patch_tokens in zip(patches_extended_files, patches_extended_tokens):
+        file.tokens = patch_tokens
+    total_tokens += sum(patches_extended_tokens)
 
     return patches_extended, total_tokens, patches_extended_tokens
 
@@ -241,8 +245,12 @@ def pr_generate_compressed_diff(top_langs: list, token_handler: TokenHandler, mo
         # if file.ai_file_summary and get_settings().config.get('config.is_auto_command', False):
         #     patch = add_ai_summary_top_patch(file, patch)
 
-        new_patch_tokens = token_handler.count_tokens(patch)
-        file_dict[file.filename] = {'patch': patch, 'tokens': new_patch_tokens, 'edit_type': file.edit_type}
+        file_dict[file.filename] = {'patch': patch, 'tokens': 0, 'edit_type': file.edit_type}
+
+    # count the tokens of all the patches in a single batched call
+    patches_tokens = token_handler.count_many([data['patch'] for data in file_dict.values()])
+    for data, new_patch_tokens in zip(file_dict.values(), patches_tokens):
+        data['tokens'] = new_patch_tokens
 
     max_tokens_model = get_max_tokens(model)
 
@@ -420,34 +428,12 @@ def get_pr_multi_diffs(git_provider: GitProvider,
     final_diff_list = []
     total_tokens = token_handler.prompt_tokens
     call_number = 1
-    for file in sorted_files:
+    for file, patch, new_patch_tokens in _iter_multi_diff_patches(sorted_files, token_handler, add_line_numbers):
         if call_number > max_calls:
             if get_settings().config.verbosity_level >= 2:
                 get_logger().info(f"Reached max calls ({max_calls})")
             break
 
-        original_file_content_str = file.base_file
-        new_file_content_str = file.head_file
-        patch = file.patch
-        if not patch:
-            continue
-
-        # Remove delete-only hunks
-        patch = handle_patch_deletions(patch, original_file_content_str, new_file_content_str, file.filename, file.edit_type)
-        if patch is None:
-            continue
-
-        # Add line numbers and metadata to the patch
-        if add_line_numbers:
-            patch = decouple_and_convert_to_hunks_with_lines_numbers(patch, file)
-        else:
-            patch = f"\n\n## File: '{file.filename.strip()}'\n\n{patch.strip()}\n"
-
-        # add AI-summary metadata to the patch
-        if file.ai_file_summary and get_settings().get("config.enable_ai_metadata", False):
-            patch = add_ai_summary_top_patch(file, patch)
-        new_patch_tokens = token_handler.count_tokens(patch)
-
         if patch and (token_handler.prompt_tokens + new_patch_tokens) > get_max_tokens(
                 model) - OUTPUT_BUFFER_TOKENS_SOFT_THRESHOLD:
             if get_settings().config.get('large_patch_policy', 'skip') == 'skip':
@@ -495,6 +481,47 @@ def get_pr_multi_diffs(git_provider: GitProvider,
     return final_diff_list
 
 
+def _iter_multi_diff_patches(sorted_files: list, token_handler: TokenHandler, add_line_numbers: bool):
+    """
+    Yields (file, patch, patch tokens) for each of the files that has a patch, in order. The patches are prepared and
+    their tokens counted in batches of MULTI_DIFF_COUNT_BATCH_SIZE files, so that the counting is batched, while the
+    files after the one a caller stops at (e.g. when reaching its max calls) are never prepared.
+    """
+    files_and_patches = []
+    for file in sorted_files:
+        original_file_content_str = file.base_file
+        new_file_content_str = file.head_file
+        patch = file.patch
+        if not patch:
+            continue
+
+        # Remove delete-only hunks
+        patch = handle_patch_deletions(patch, original_file_content_str, new_file_content_str, file.filename, file.edit_type)
+        if patch is None:
+            continue
+
+        # Add line numbers and metadata to the patch
+        if add_line_numbers:
+            patch = decouple_and_convert_to_hunks_with_lines_numbers(patch, file)
+        else:
+            patch = f"\n\n## File: '{file.filename.strip()}'\n\n{patch.strip()}\n"
+
+        # add AI-summary metadata to the patch
+        if file.ai_file_summary and get_settings().get("config.enable_ai_metadata", False):
+            patch = add_ai_summary_top_patch(file, patch)
+        files_and_patches.append((file, patch))
+        if len(files_and_patches) >= MULTI_DIFF_COUNT_BATCH_SIZE:
+            yield from _with_patch_tokens(files_and_patches, token_handler)
+            files_and_patches = []
+    yield from _with_patch_tokens(files_and_patches, token_handler)
+
+
+def _with_patch_tokens(files_and_patches: list, token_handler: TokenHandler):
+    patches_tokens = token_handler.count_many([patch for _, patch in files_and_patches])
+    for (file, patch), patch_tokens in zip(files_and_patches, patches_tokens):
+        yield file, patch, patch_tokens
+
+
 def add_ai_metadata_to_diff_files(git_provider, pr_description_files):
     """
     Adds AI metadata to the diff files based on the PR description files (FilePatchInfo.ai_file_summary).
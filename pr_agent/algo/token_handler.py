@@ -1,32 +1,182 @@
+import hashlib
+import os
+import re
+import sys
+from array import array
+from functools import cache, lru_cache
+from importlib.resources import files
+from math import ceil
 from threading import Lock
+from typing import Optional, Sequence
 
-from jinja2 import Environment, StrictUndefined
-from tiktoken import encoding_for_model, get_encoding
+import anthropic
+from jinja2 import Environment, StrictUndefined, Template
+from tiktoken import get_encoding
+from tiktoken.model import encoding_name_for_model
 
+from pr_agent.algo import MAX_TOKENS
 from pr_agent.config_loader import get_settings
 from pr_agent.log import get_logger
 
+_O_SERIES_RE = re.compile(r"^o[1-9](-mini|-preview)?$")
+
+# Shared by all TokenHandler instances. Environment construction (lexer setup, etc.) is done once, at import.
+_JINJA_ENV = Environment(undefined=StrictUndefined, cache_size=512, auto_reload=False)
+
+NANOTOK_AVAILABLE = True
+try:
+    # noinspection PyUnresolvedReferences
+    import nanotok
+except ImportError:
+    NANOTOK_AVAILABLE = False
+
+XXHASH_AVAILABLE = True
+try:
+    # noinspection PyUnresolvedReferences
+    import xxhash
+except ImportError:
+    XXHASH_AVAILABLE = False
+
+TOKENIZERS_AVAILABLE = True
+try:
+    # noinspection PyUnresolvedReferences
+    from tokenizers import Tokenizer
+except ImportError:
+    TOKENIZERS_AVAILABLE = False
+
+# Claude tokenizer vocabulary bundled with litellm
+CLAUDE_TOKENIZER_PACKAGE = "litellm.litellm_core_utils.tokenizers"
+CLAUDE_TOKENIZER_FILE = "anthropic_tokenizer.json"
+
+
+class TokenEncoderAdapter:
+    """
+    A thin wrapper around a BPE backend (nanotok if installed, tiktoken otherwise).
+
+    Exposes the tiktoken Encoding API (encode, decode, ...), plus a count() shortcut that uses the backend's native
+    counter when it has one, instead of building the full list of token ids just to take its length.
+    """
+
+    def __init__(self, encoding):
+        self._encoding = encoding
+        self._native_count = getattr(encoding, "count", None)
+        self._encode_ordinary = getattr(encoding, "encode_ordinary", None)
+
+    def count(self, text: str) -> int:
+        if self._native_count is not None:
+            return self._native_count(text)
+        if self._encode_ordinary is not None:
+            # Same tokens as encode(text, disallowed_special=()), without the special tokens handling. The token
+            # list is only alive for the len() call.
+            return len(self._encode_ordinary(text))
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_batch(self, texts: list[str], num_threads: int = None) -> list[int]:
+        num_threads = num_threads or os.cpu_count() or 8
+        if hasattr(self._encoding, "encode_ordinary_batch"):
+            return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(texts, num_threads=num_threads)]
+        if hasattr(self._encoding, "encode_batch"):
+            return [len(tokens) for tokens in self._encoding.encode_batch(texts)]
+        return [self.count(text) for text in texts]
+
+    def __getattr__(self, name):
+        return getattr(self._encoding, name)
+
+
+@cache
+def _get_encoder(model: str) -> TokenEncoderAdapter:
+    # One encoder per model. functools.cache makes the steady state a single dict lookup, with no lock taken.
+    # Two threads racing on the very first call may both load the encoding, which is harmless.
+    try:
+        encoding_name = encoding_name_for_model(model) if "gpt" in model else "o200k_base"
+    except:
+        encoding_name = "o200k_base"
+    if NANOTOK_AVAILABLE:
+        try:
+            return TokenEncoderAdapter(nanotok.Tokenizer.from_tiktoken(encoding_name))
+        except Exception as e:
+            get_logger().warning(f"Failed to load nanotok tokenizer {encoding_name}, falling back to tiktoken: {e}")
+    return TokenEncoderAdapter(get_encoding(encoding_name))
+
+
+@cache
+def _get_local_claude_tokenizer():
+    # Loaded once, on first use. Returns None if the tokenizer cannot be loaded, so callers fall back to the API.
+    if not TOKENIZERS_AVAILABLE:
+        get_logger().warning("The 'tokenizers' package is not installed, local Claude token counting is unavailable")
+        return None
+    try:
+        tokenizer_json = files(CLAUDE_TOKENIZER_PACKAGE).joinpath(CLAUDE_TOKENIZER_FILE).read_text(encoding='utf-8')
+        return Tokenizer.from_str(tokenizer_json)
+    except Exception as e:
+        get_logger().warning(f"Failed to load the local Claude tokenizer: {e}")
+        return None
+
 
 class TokenEncoder:
     _encoder_instance = None
     _model = None
-    _lock = Lock()  # Create a lock object
 
     @classmethod
     def get_token_encoder(cls):
+        # The model is read on every call, since the settings can differ per request (server mode).
+        # _get_encoder keeps one encoder per model, so this stays cheap.
         model = get_settings().config.model
-        if cls._encoder_instance is None or model != cls._model:  # Check without acquiring the lock for performance
-            with cls._lock:  # Lock acquisition to ensure thread safety
-                if cls._encoder_instance is None or model != cls._model:
-                    cls._model = model
-                    try:
-                        cls._encoder_instance = encoding_for_model(cls._model) if "gpt" in cls._model else get_encoding(
-                            "o200k_base")
-                    except:
-                        cls._encoder_instance = get_encoding("o200k_base")
+        cls._encoder_instance = _get_encoder(model)
+        cls._model = model
         return cls._encoder_instance
 
 
+# Patches at least this long (in chars) bypass the token count cache, so a few huge inputs cannot bloat memory.
+MAX_CACHED_PATCH_LENGTH = 1_000_000
+
+
+# The text is fed to xxhash in slices of this many chars, so no full-size UTF-8 copy of a large patch is made
+L0_HASH_CHUNK_CHARS = 64 * 1024
+
+
+def _l0_key(model_key: str, text: str) -> int:
+    # Only a 64-bit digest of (model, text) is kept as key, never the text itself. The model is part of the key, so
+    # entries of a previous model simply go cold. Hashing the UTF-8 slices one after the other gives the same digest
+    # as hashing the whole encoded text.
+    if XXHASH_AVAILABLE:
+        hasher = xxhash.xxh3_64(f"{model_key}\0".encode('utf-8'))
+        for start in range(0, len(text), L0_HASH_CHUNK_CHARS):
+            hasher.update(text[start:start + L0_HASH_CHUNK_CHARS].encode('utf-8'))
+        return hasher.intdigest()
+    return hash((model_key, text))  # str hashes are computed once and cached on the string object
+
+
+def _utf8_length_exceeds(text: str, max_bytes: int) -> bool:
+    # A code point takes 1 to 4 bytes in UTF-8, so most texts are decided from their length alone,
+    # without materializing an encoded copy.
+    if len(text) > max_bytes:
+        return True
+    if len(text) * 4 <= max_bytes or text.isascii():
+        return False
+    return len(text.encode('utf-8')) > max_bytes
+
+
+def _find_all(text: str, marker: str):
+    idx = text.find(marker)
+    while idx != -1:
+        yield idx
+        idx = text.find(marker, idx + len(marker))
+
+
+def _find_split_points(text: str, marker: str):
+    # Positions right after the leading newlines of each occurrence of marker, when a newline precedes them. A newline
+    # followed by a character that is neither whitespace nor '/' ends a pre-token in all the tiktoken encodings, and BPE
+    # never merges across pre-tokens, so the token counts of the two sides add up exactly to the count of the whole text.
+    # Splitting before the newlines would not be exact, e.g. o200k pre-tokenizes "text.\n\n### Header" as
+    # ['text', '.\n\n', '###', ' Header'].
+    offset = len(marker) - len(marker.lstrip('\n'))
+    for idx in _find_all(text, marker):
+        split_idx = idx + offset
+        if split_idx > 0 and text[split_idx - 1] == '\n':
+            yield split_idx
+
+
 class TokenHandler:
     """
     A class for handling tokens in the context of a pull request.
@@ -38,8 +188,24 @@ class TokenHandler:
       pr_agent.algo module.
     - prompt_tokens: The number of tokens in the system and user strings, as calculated by the _get_system_user_tokens
       method.
+    - prefix_boundaries: Markers at which a text is split, so that the token count of a long shared prefix (system
+      prompt, static PR context) is computed once and only the changing suffix is encoded on later calls. A text is
+      split after the leading newlines of a marker, and only if a newline precedes that point, so what follows them
+      must start with a character that is neither whitespace nor '/'.
     """
 
+    prefix_boundaries = ["<|system|>", "\n\n### ", "\n---\n"]
+    L0_MAX_ENTRIES = 10_000
+    # digest of (model, text) -> its token count. Accurate counts are stored too, under their counting method as model.
+    _l0: dict[int, int] = {}
+    _l0_lock = Lock()
+    L1_MAX_MEMORY = 50 * 1024 * 1024  # bytes
+    _l1_prefix_counts: dict[str, int] = {}  # sha1 of a boundary-terminated prefix -> its token count
+    _l1_memory = 0
+    _l1_lock = Lock()
+    _anth_client: Optional[tuple[str, anthropic.Anthropic]] = None  # (api key, client)
+    _lock = Lock()
+
     def __init__(self, pr=None, vars: dict = {}, system="", user=""):
         """
         Initializes the TokenHandler object.
@@ -50,10 +216,36 @@ class TokenHandler:
         - system: The system string.
         - user: The user string.
         """
-        self.encoder = TokenEncoder.get_token_encoder()
+        self._max_tokens = None
+        # Snapshot of the settings used by count_tokens, so the hot path does not walk the settings on every call
+        self._model = get_settings().config.model
+        self.encoder = _get_encoder(self._model)
+        self._model_lower = self._model.lower()
+        self._anth_key = get_settings(use_context=False).get('anthropic.key')
+        self._has_anth_key = bool(self._anth_key)
+        self._has_openai_key = bool(get_settings(use_context=False).get('openai.key'))
+        self._claude_local_token_count = get_settings().get('config.claude_local_token_count', False)
+        self._elbow_factor = 1 + get_settings().get('config.model_token_count_estimate_factor', 0)
+        self._accurate_count_impl = self._select_accurate_count_impl()
         if pr is not None:
             self.prompt_tokens = self._get_system_user_tokens(pr, self.encoder, vars, system, user)
 
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def _compile_template(source: str) -> Template:
+        # Environment.from_string parses and compiles the source on every call (Jinja's own cache only serves
+        # loader-based templates), so compiled templates are kept here. Prompt templates come from the settings and are
+        # few, so after the first use of each one this is a lookup.
+        return _JINJA_ENV.from_string(source)
+
+    @classmethod
+    def _render_prompt(cls, source: str, vars: dict) -> str:
+        if not any(token in source for token in ('{{', '{%', '{#', '\r')):
+            # No template syntax (nor newlines Jinja would normalize), so rendering would only drop a single trailing
+            # newline, as Jinja does by default
+            return source[:-1] if source.endswith('\n') else source
+        return cls._compile_template(source).render(vars)
+
     def _get_system_user_tokens(self, pr, encoder, vars: dict, system, user):
         """
         Calculates the number of tokens in the system and user strings.
@@ -69,30 +261,47 @@ class TokenHandler:
         The sum of the number of tokens in the system and user strings.
         """
         try:
-            environment = Environment(undefined=StrictUndefined)
-            system_prompt = environment.from_string(system).render(vars)
-            user_prompt = environment.from_string(user).render(vars)
-            system_prompt_tokens = len(encoder.encode(system_prompt))
-            user_prompt_tokens = len(encoder.encode(user_prompt))
+            system_prompt = self._render_prompt(system, vars)
+            user_prompt = self._render_prompt(user, vars)
+            system_prompt_tokens = encoder.count(system_prompt)
+            user_prompt_tokens = encoder.count(user_prompt)
             return system_prompt_tokens + user_prompt_tokens
         except Exception as e:
             get_logger().error(f"Error in _get_system_user_tokens: {e}")
             return 0
 
+    @classmethod
+    def _get_anthropic_client(cls, api_key: str) -> anthropic.Anthropic:
+        # A single client is shared by all instances, so its HTTP connection pool (and TLS sessions) are reused across
+        # calls. It is rebuilt only if the configured key changes.
+        cached = cls._anth_client
+        if cached is None or cached[0] != api_key:
+            with cls._lock:
+                cached = cls._anth_client
+                if cached is None or cached[0] != api_key:
+                    cached = (api_key, anthropic.Anthropic(api_key=api_key))
+                    cls._anth_client = cached
+        return cached[1]
+
     def calc_claude_tokens(self, patch):
         try:
-            import anthropic
-            from pr_agent.algo import MAX_TOKENS
-            client = anthropic.Anthropic(api_key=get_settings(use_context=False).get('anthropic.key'))
-            MaxTokens = MAX_TOKENS[get_settings().config.model]
+            client = self._get_anthropic_client(self._anth_key)
+            if self._max_tokens is None:
+                self._max_tokens = MAX_TOKENS[self._model]
+            MaxTokens = self._max_tokens
 
             # Check if the content size is too large (9MB limit)
-            if len(patch.encode('utf-8')) > 9_000_000:
+            if _utf8_length_exceeds(patch, 9_000_000):
                 get_logger().warning(
                     "Content too large for Anthropic token counting API, falling back to local tokenizer"
                 )
                 return MaxTokens
 
+            # The count is the same for any configured Claude model, as it is always made with the same model below
+            key = _l0_key("anthropic-count-tokens-api", patch)
+            token_count = self._l0.get(key)
+            if token_count is not None:
+                return token_count
             response = client.messages.count_tokens(
                 model="claude-3-7-sonnet-20250219",
                 system="system",
@@ -101,45 +310,199 @@ class TokenHandler:
                     "content": patch
                 }],
             )
+            self._store_l0_count(key, response.input_tokens)  # Errors below fall back to MaxTokens, which isn't cached
             return response.input_tokens
 
         except Exception as e:
             get_logger().error( f"Error in Anthropic token counting: {e}")
             return MaxTokens
 
-    def estimate_token_count_for_non_anth_claude_models(self, model, default_encoder_estimate):
-        from math import ceil
-        import re
+    def calc_claude_tokens_locally(self, patch) -> Optional[int]:
+        # Counts tokens with a local Claude tokenizer: no network round trip and no upload size limit.
+        # Returns None if the local tokenizer is unavailable.
+        tokenizer = _get_local_claude_tokenizer()
+        if tokenizer is None:
+            return None
+        key = _l0_key("claude-local", patch)
+        token_count = self._l0.get(key)
+        if token_count is None:
+            token_count = len(tokenizer.encode(patch, add_special_tokens=False).ids)
+            self._store_l0_count(key, token_count)
+        return token_count
 
-        model_is_from_o_series = re.match(r"^o[1-9](-mini|-preview)?$", model)
-        if ('gpt' in get_settings().config.model.lower() or model_is_from_o_series) and get_settings(use_context=False).get('openai.key'):
+    def estimate_token_count_for_non_anth_claude_models(self, model, default_encoder_estimate):
+        model_is_from_o_series = _O_SERIES_RE.match(model)
+        if ('gpt' in self._model_lower or model_is_from_o_series) and self._has_openai_key:
             return default_encoder_estimate
         #else: Model is not an OpenAI one - therefore, cannot provide an accurate token count and instead, return a higher number as best effort.
 
-        elbow_factor = 1 + get_settings().get('config.model_token_count_estimate_factor', 0)
+        elbow_factor = self._elbow_factor
         get_logger().warning(f"{model}'s expected token count cannot be accurately estimated. Using {elbow_factor} of encoder output as best effort estimate")
         return ceil(elbow_factor * default_encoder_estimate)
 
+    @classmethod
+    def _count_with_prefix_cache(cls, encoder, model_key: str, text: str) -> int:
+        """
+        Counts the tokens of a text, reusing the cached count of its longest previously seen boundary-terminated prefix.
+
+        The text is split at the boundary markers (see _find_split_points), and the counts of the segments are summed.
+        The splits are at pre-tokenization boundaries, so the sum is exactly the count of the whole text.
+        """
+        boundaries = sorted({idx for marker in cls.prefix_boundaries for idx in _find_split_points(text, marker)})
+        if not boundaries:
+            return encoder.count(text)
+
+        # Hash every boundary-terminated prefix incrementally, so hashing stays linear in the text length
+        hasher = hashlib.sha1(f"{model_key}\0".encode('utf-8'))
+        prefix_keys = []
+        start = 0
+        for end in boundaries:
+            hasher.update(text[start:end].encode('utf-8'))
+            prefix_keys.append(hasher.hexdigest())
+            start = end
+
+        # Find the longest cached prefix
+        cached_idx, token_count = -1, 0
+        for idx in range(len(prefix_keys) - 1, -1, -1):
+            cached_count = cls._l1_prefix_counts.get(prefix_keys[idx])
+            if cached_count is not None:
+                cached_idx, token_count = idx, cached_count
+                break
+
+        # Encode only the segments after it, caching the count of every new prefix on the way
+        start = boundaries[cached_idx] if cached_idx >= 0 else 0
+        for idx in range(cached_idx + 1, len(boundaries)):
+            token_count += encoder.count(text[start:boundaries[idx]])
+            cls._store_prefix_count(prefix_keys[idx], token_count)
+            start = boundaries[idx]
+        return token_count + encoder.count(text[start:])
+
+    @classmethod
+    def _store_prefix_count(cls, key: str, token_count: int):
+        with cls._l1_lock:
+            if key in cls._l1_prefix_counts:
+                return
+            cls._l1_prefix_counts[key] = token_count
+            cls._l1_memory += sys.getsizeof(key) + sys.getsizeof(token_count)
+            while cls._l1_memory > cls.L1_MAX_MEMORY and cls._l1_prefix_counts:
+                # Dicts keep insertion order, so the first key is the oldest one
+                oldest_key = next(iter(cls._l1_prefix_counts))
+                oldest_count = cls._l1_prefix_counts.pop(oldest_key)
+                cls._l1_memory -= sys.getsizeof(oldest_key) + sys.getsizeof(oldest_count)
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Clears the caches of token counts used by count_tokens.
+        """
+        with cls._l0_lock:
+            cls._l0.clear()
+        with cls._l1_lock:
+            cls._l1_prefix_counts.clear()
+            cls._l1_memory = 0
+
+    def count_tokens_batch(self, patches: list[str]) -> list[int]:
+        """
+        Counts the number of tokens in each of the given patch strings. See count_many.
+
+        Args:
+        - patches: The patch strings.
+
+        Returns:
+        The number of tokens in each patch string, in the same order.
+        """
+        return list(self.count_many(patches))
+
+    def count_many(self, texts: Sequence[str]) -> array:
+        """
+        Counts the number of tokens in each of the given texts, with the same cache as count_tokens.
+
+        Texts whose count is cached are not encoded again. The rest are counted in a single batched encoder call (tiktoken
+        runs it over a thread pool, with the GIL released while encoding), and their counts are cached.
+
+        Args:
+        - texts: The texts.
+
+        Returns:
+        A compact int array, parallel to texts, holding the number of tokens in each text. Empty texts count 0 tokens
+        and are not sent to the encoder.
+        """
+        counts = array('l', [0]) * len(texts)
+        miss_idx = []
+        miss_keys = []  # None for texts too long to be cached
+        for idx, text in enumerate(texts):
+            if not text:
+                continue
+            key = None
+            if len(text) < MAX_CACHED_PATCH_LENGTH:
+                key = _l0_key(self._model, text)
+                token_count = self._l0.get(key)
+                if token_count is not None:
+                    counts[idx] = token_count
+                    continue
+            miss_idx.append(idx)
+            miss_keys.append(key)
+        if miss_idx:
+            miss_counts = self.encoder.count_batch([texts[idx] for idx in miss_idx])
+            for idx, key, token_count in zip(miss_idx, miss_keys, miss_counts):
+                counts[idx] = token_count
+                if key is not None:
+                    self._store_l0_count(key, token_count)
+        return counts
+
+    def _select_accurate_count_impl(self):
+        # Decides once, from the settings snapshot, how count_tokens(force_accurate=True) counts tokens.
+        model = self._model_lower
+        if 'claude' in model and self._claude_local_token_count and _get_local_claude_tokenizer() is not None:
+            return self.calc_claude_tokens_locally
+        if 'claude' in model and self._has_anth_key:
+            return self.calc_claude_tokens  # API call to Anthropic for accurate token counting for Claude models
+        #else: Non Anthropic provided model:
+        return lambda patch: self.estimate_token_count_for_non_anth_claude_models(model, self._count_estimate(patch))
+
+    def _count_estimate(self, patch: str) -> int:
+        model_key = self._model
+        if len(patch) >= MAX_CACHED_PATCH_LENGTH:
+            return self._count_with_prefix_cache(self.encoder, model_key, patch)
+        key = _l0_key(model_key, patch)
+        token_count = self._l0.get(key)
+        if token_count is None:
+            token_count = self._count_with_prefix_cache(self.encoder, model_key, patch)
+            self._store_l0_count(key, token_count)
+        return token_count
+
+    @classmethod
+    def _store_l0_count(cls, key: int, token_count: int):
+        with cls._l0_lock:
+            cls._l0[key] = token_count
+            if len(cls._l0) > cls.L0_MAX_ENTRIES:
+                # Dicts keep insertion order, so the first key is the oldest one
+                cls._l0.pop(next(iter(cls._l0)))
+
     def count_tokens(self, patch: str, force_accurate=False) -> int:
         """
         Counts the number of tokens in a given patch string.
 
         Args:
         - patch: The patch string.
+        - force_accurate: Whether to return an accurate count for the configured model (which may be slower, e.g. an API
+          call for Claude models) rather than the local encoder estimate.
 
         Returns:
         The number of tokens in the patch string.
         """
-        encoder_estimate = len(self.encoder.encode(patch, disallowed_special=()))
-
+        if not patch:
+            return 0
         #If an estimate is enough (for example, in cases where the maximal allowed tokens is way below the known limits), return it.
         if not force_accurate:
-            return encoder_estimate
-
+            return self._count_estimate(patch)
         #else, force_accurate==True: User requested providing an accurate estimation:
-        model = get_settings().config.model.lower()
-        if 'claude' in model and get_settings(use_context=False).get('anthropic.key'):
-            return self.calc_claude_tokens(patch) # API call to Anthropic for accurate token counting for Claude models
+        return self._accurate_count_impl(patch)
 
-        #else: Non Anthropic provided model:
-        return self.estimate_token_count_for_non_anth_claude_models(model, encoder_estimate)
+
+# Load the tokenizer vocabulary at import time, so the first request does not pay for it
+if not os.getenv("PR_AGENT_SKIP_PREWARM"):
+    try:
+        TokenEncoder.get_token_encoder().count("warmup")
+    except Exception as e:
+        get_logger().debug(f"Failed to pre-warm the token encoder: {e}")
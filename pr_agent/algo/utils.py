@@ -902,7 +902,7 @@ def clip_tokens(text: str, max_tokens: int, add_three_dots=True, num_input_token
     try:
         if num_input_tokens is None:
             encoder = TokenEncoder.get_token_encoder()
-            num_input_tokens = len(encoder.encode(text))
+            num_input_tokens = encoder.count(text)
         if num_input_tokens <= max_tokens:
             return text
         if max_tokens < 0:
@@ -532,14 +532,20 @@ class BitbucketServerProvider(GitProvider):
 
     #Overriding the shell command, since for some reason usage of x-token-auth doesn't work, as mentioned here:
     # https://stackoverflow.com/questions/56760396/cloning-bitbucket-server-repo-with-access-tokens
-    def _clone_inner(self, repo_url: str, dest_folder: str, operation_timeout_in_seconds: int=None):
+    def _clone_inner(self, repo_url: str, dest_folder: str, operation_timeout_in_seconds: int=None,
+                     sparse_checkout_paths: list[str]=None):
         bearer_token = self.bearer_token
         if not bearer_token:
             #Shouldn't happen since this is checked in _prepare_clone, therefore - throwing an exception.
             raise RuntimeError(f"Bearer token is required!")
 
+        sparse_arg = "--sparse " if sparse_checkout_paths else ""
         cli_args = shlex.split(f"git clone -c http.extraHeader='Authorization: Bearer {bearer_token}' "
-                               f"--filter=blob:none --depth 1 {repo_url} {dest_folder}")
+                               f"--filter=blob:none --depth 1 {sparse_arg}{repo_url} {dest_folder}")
 
         subprocess.run(cli_args, check=True,  # check=True will raise an exception if the command fails
             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=operation_timeout_in_seconds)
+        if sparse_checkout_paths:
+            # The missing blobs are fetched by this command as well, so it needs the same header
+            self._sparse_checkout_add(dest_folder, sparse_checkout_paths, operation_timeout_in_seconds,
+                                      git_args=["-c", f"http.extraHeader=Authorization: Bearer {bearer_token}"])
@@ -51,8 +51,11 @@ class GitProvider(ABC):
         return None
 
     # Does a shallow clone, using a forked process to support a timeout guard.
+    # If sparse_checkout_paths is given, only the files directly under the repo root and the given directories are
+    # checked out (sparse checkout in cone mode), so blobs of other paths are never downloaded.
     # In case operation has failed, it is expected to throw an exception as this method does not return a value.
-    def _clone_inner(self, repo_url: str, dest_folder: str, operation_timeout_in_seconds: int=None) -> None:
+    def _clone_inner(self, repo_url: str, dest_folder: str, operation_timeout_in_seconds: int=None,
+                     sparse_checkout_paths: list[str]=None) -> None:
         #The following ought to be equivalent to:
         # #Repo.clone_from(repo_url, dest_folder)
         # , but with throwing an exception upon timeout.
@@ -61,15 +64,30 @@ class GitProvider(ABC):
             "git", "clone",
             "--filter=blob:none",
             "--depth", "1",
+            *(["--sparse"] if sparse_checkout_paths else []),
             repo_url, dest_folder
         ], check=True,  # check=True will raise an exception if the command fails
             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=operation_timeout_in_seconds)
+        if sparse_checkout_paths:
+            self._sparse_checkout_add(dest_folder, sparse_checkout_paths, operation_timeout_in_seconds)
+
+    # Adds directories to the sparse checkout of a repo cloned with --sparse. git_args are passed to git before the
+    # sub command, for example to provide authentication headers for fetching the missing blobs.
+    def _sparse_checkout_add(self, dest_folder: str, sparse_checkout_paths: list[str], operation_timeout_in_seconds: int=None,
+                             git_args: list[str]=None) -> None:
+        subprocess.run([
+            "git", *(git_args or []), "-C", dest_folder,
+            "sparse-checkout", "add", *sparse_checkout_paths
+        ], check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=operation_timeout_in_seconds)
 
     CLONE_TIMEOUT_SEC = 20
     # Clone a given url to a destination folder. If successful, returns an object that wraps the destination folder,
     # deleting it once it is garbage collected. See: GitProvider.ScopedClonedRepo for more details.
+    # sparse_checkout_paths: If given, only these directories (and the files directly under the repo root) are checked
+    # out. If the sparse clone fails (for example, with an old git version), a regular clone is done instead.
     def clone(self, repo_url_to_clone: str, dest_folder: str, remove_dest_folder: bool = True,
-              operation_timeout_in_seconds: int=CLONE_TIMEOUT_SEC) -> ScopedClonedRepo|None:
+              operation_timeout_in_seconds: int=CLONE_TIMEOUT_SEC, sparse_checkout_paths: list[str]=None) -> ScopedClonedRepo|None:
         returned_obj = None
         clone_url = self._prepare_clone_url_with_token(repo_url_to_clone)
         if not clone_url:
@@ -78,8 +96,20 @@ class GitProvider(ABC):
         try:
             if remove_dest_folder and os.path.exists(dest_folder) and os.path.isdir(dest_folder):
                 shutil.rmtree(dest_folder)
-            self._clone_inner(clone_url, dest_folder, operation_timeout_in_seconds)
-            returned_obj = GitProvider.ScopedClonedRepo(dest_folder)
+            if sparse_checkout_paths:
+                try:
+                    self._clone_inner(clone_url, dest_folder, operation_timeout_in_seconds,
+                                      sparse_checkout_paths=sparse_checkout_paths)
+                    returned_obj = GitProvider.ScopedClonedRepo(dest_folder)
+                except Exception as e:
+                    get_logger().warning(f"Sparse clone failed, falling back to a regular clone.", artifact={"error": str(e)})
+                    # Empty the destination folder (but keep it, as it may be owned by the caller), for the clone below
+                    if os.path.isdir(dest_folder):
+                        shutil.rmtree(dest_folder)
+                        os.makedirs(dest_folder)
+            if not returned_obj:
+                self._clone_inner(clone_url, dest_folder, operation_timeout_in_seconds)
+                returned_obj = GitProvider.ScopedClonedRepo(dest_folder)
         except Exception as e:
             get_logger().exception(f"Clone failed: Could not clone url.",
                 artifact={"error": str(e), "url": clone_url, "dest_folder": dest_folder})
@@ -291,8 +291,7 @@ class PRDescription:
                         get_logger().debug(f"Too many deleted files, clipping to {MAX_EXTRA_FILES_TO_PROMPT}")
                         files_walkthrough_prompt += f"\n... and {len(deleted_files_list) - MAX_EXTRA_FILES_TO_PROMPT} more"
                         break
-            tokens_files_walkthrough = len(
-                token_handler_only_description_prompt.encoder.encode(files_walkthrough_prompt))
+            tokens_files_walkthrough = token_handler_only_description_prompt.encoder.count(files_walkthrough_prompt)
             total_tokens = token_handler_only_description_prompt.prompt_tokens + tokens_files_walkthrough
             max_tokens_model = get_max_tokens(model)
             if total_tokens > max_tokens_model - OUTPUT_BUFFER_TOKENS_HARD_THRESHOLD:
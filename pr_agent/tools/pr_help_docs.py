@@ -1,18 +1,23 @@
-import copy
-from functools import partial
-
-from jinja2 import Environment, StrictUndefined
+import hashlib
+import json
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import accumulate
+
+from jinja2 import Environment, StrictUndefined, Template
 import math
 import os
 import re
-from tempfile import TemporaryDirectory
+import time
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 from pr_agent.algo import MAX_TOKENS
 from pr_agent.algo.ai_handlers.base_ai_handler import BaseAiHandler
 from pr_agent.algo.ai_handlers.litellm_ai_handler import LiteLLMAIHandler
 from pr_agent.algo.pr_processing import retry_with_fallback_models
 from pr_agent.algo.token_handler import TokenHandler
-from pr_agent.algo.utils import clip_tokens, get_max_tokens, load_yaml, ModelType
+from pr_agent.algo.utils import get_max_tokens, load_yaml, ModelType
 from pr_agent.config_loader import get_settings
 from pr_agent.git_providers import get_git_provider_with_context
 from pr_agent.log import get_logger
@@ -60,12 +65,12 @@ def extract_model_answer_and_relevant_sources(ai_response: str) -> str | None:
     The answer part is: "According to the documentation, one needs to invoke the command: /review\n\n"
     followed by "Relevant Sources:\n\n".
     """
-    if "### Answer:\n" in ai_response:
-        model_answer_and_relevant_sources_sections_in_response = ai_response.split("### Answer:\n")[-1]
+    _, answer_sep, model_answer_and_relevant_sources_sections_in_response = ai_response.rpartition("### Answer:\n")
+    if answer_sep:
         # Split such part by "Relevant Sources" section to contain only the model answer:
-        if "#### Relevant Sources:\n\n" in model_answer_and_relevant_sources_sections_in_response:
-            model_answer_section_in_response \
-                = model_answer_and_relevant_sources_sections_in_response.split("#### Relevant Sources:\n\n")[0]
+        model_answer_section_in_response, sources_sep, _ \
+            = model_answer_and_relevant_sources_sections_in_response.partition("#### Relevant Sources:\n\n")
+        if sources_sep:
             get_logger().info(f"Found model answer: {model_answer_section_in_response}")
             return model_answer_and_relevant_sources_sections_in_response \
                 if len(model_answer_section_in_response) > 0 else None
@@ -78,12 +83,31 @@ def get_maximal_text_input_length_for_token_count_estimation():
         return 900000 #Claude API for token estimation allows maximal text input of 900K chars
     return math.inf #Otherwise, no known limitation on input text just for token estimation
 
+# A fast token estimate below this fraction of the token limit is trusted without an accurate count
+FAST_TOKEN_ESTIMATE_MAX_RATIO = 0.6
+
+def _fast_token_estimate(text: str, model: str) -> int:
+    # Rough token count, from the number of characters alone. English text averages about 4 characters per token
+    # (a bit less for Claude tokenizers). Non ASCII text (CJK, emoji, ...) can take more than a token per character,
+    # so its UTF-8 length is used: a byte level BPE token always covers at least one byte, so it is an upper bound.
+    if not text.isascii():
+        return len(text.encode('utf-8'))
+    avg_chars_per_token = 3.5 if 'claude' in model.lower() else 4
+    return math.ceil(len(text) / avg_chars_per_token)
+
+# Documentation files smaller than this can't hold anything useful, so they are not read
+MIN_DOC_FILE_BYTES = 16
+
+_ASCII_LETTER_RE = re.compile(r'[a-zA-Z]')
+# All the byte values except ASCII letters, for deleting them with bytes.translate
+_NON_ASCII_LETTER_BYTES = bytes(i for i in range(256) if not (ord('A') <= i <= ord('Z') or ord('a') <= i <= ord('z')))
+
 def return_document_headings(text: str, ext: str) -> str:
     try:
         lines = text.split('\n')
         headings = set()
 
-        if not text or not re.search(r'[a-zA-Z]', text):
+        if not text or not _ASCII_LETTER_RE.search(text):
             get_logger().error(f"Empty or non text content found in text: {text}.")
             return ""
 
@@ -116,25 +140,38 @@ def return_document_headings(text: str, ext: str) -> str:
         get_logger().exception(f"Unexpected exception thrown. Returning empty result.")
         return ""
 
+def _read_documentation_file(file: str, max_allowed_file_len: int) -> str | None:
+    # Returns the (possibly trimmed) contents of the file, or None if it cannot be read or contains no text
+    try:
+        with open(file, 'rb') as f:
+            raw_content = f.read()
+        # Skip files with no text content. Checked on the raw bytes, so such files are never decoded.
+        if not raw_content.translate(None, _NON_ASCII_LETTER_BYTES):
+            return None
+        # Same newline handling as reading in text mode
+        content = raw_content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        if len(content) > max_allowed_file_len:
+            get_logger().warning(f"File {file} length: {len(content)} exceeds limit: {max_allowed_file_len}, so it will be trimmed.")
+            content = content[:max_allowed_file_len]
+        return content.strip()
+    except Exception as e:
+        get_logger().warning(f"Error while reading the file {file}: {e}")
+        return None
+
 # Load documentation files to memory: full file path (as will be given as prompt) -> doc contents
 def map_documentation_files_to_contents(base_path: str, doc_files: list[str], max_allowed_file_len=5000) -> dict[str, str]:
     try:
         returned_dict = {}
-        for file in doc_files:
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    # Skip files with no text content
-                    if not re.search(r'[a-zA-Z]', content):
-                        continue
-                    if len(content) > max_allowed_file_len:
-                        get_logger().warning(f"File {file} length: {len(content)} exceeds limit: {max_allowed_file_len}, so it will be trimmed.")
-                        content = content[:max_allowed_file_len]
-                    file_path = str(file).replace(str(base_path), '')
-                    returned_dict[file_path] = content.strip()
-            except Exception as e:
-                get_logger().warning(f"Error while reading the file {file}: {e}")
-                continue
+        if doc_files:
+            # File reads release the GIL, so reading in parallel overlaps the I/O latency of the files.
+            # map() returns the results in the order of doc_files.
+            with ThreadPoolExecutor(max_workers=min(32, len(doc_files))) as executor:
+                contents = executor.map(partial(_read_documentation_file, max_allowed_file_len=max_allowed_file_len),
+                                        doc_files)
+                for file, content in zip(doc_files, contents):
+                    if content is not None:
+                        file_path = str(file).replace(str(base_path), '')
+                        returned_dict[file_path] = content
         if not returned_dict:
             get_logger().error("Couldn't find any usable documentation files. Returning empty dict.")
         return returned_dict
@@ -143,10 +180,10 @@ def map_documentation_files_to_contents(base_path: str, doc_files: list[str], ma
         return {}
 
 # Goes over files' contents, generating payload for prompt while decorating them with a header to mark where each file begins,
-# as to help the LLM to give a better answer.
-def aggregate_documentation_files_for_prompt_contents(file_path_to_contents: dict[str, str], return_just_headings=False) -> str:
+# as to help the LLM to give a better answer. Returns one segment per file, so they can be processed (and joined) later.
+def aggregate_documentation_files_for_prompt_segments(file_path_to_contents: dict[str, str], return_just_headings=False) -> list[str]:
     try:
-        docs_prompt = ""
+        docs_prompt_parts = []
         for idx, file_path in enumerate(file_path_to_contents):
             file_contents = file_path_to_contents[file_path].strip()
             if not file_contents:
@@ -155,69 +192,147 @@ def aggregate_documentation_files_for_prompt_contents(file_path_to_contents: dic
             if return_just_headings:
                 file_headings = return_document_headings(file_contents, os.path.splitext(file_path)[-1]).strip()
                 if file_headings:
-                    docs_prompt += f"\n==file name==\n\n{file_path}\n\n==index==\n\n{idx}\n\n==file headings==\n\n{file_headings}\n=========\n\n"
+                    docs_prompt_parts.append(f"\n==file name==\n\n{file_path}\n\n==index==\n\n{idx}\n\n==file headings==\n\n{file_headings}\n=========\n\n")
                 else:
                     get_logger().warning(f"No headers for: {file_path}. Will only use filename")
-                    docs_prompt += f"\n==file name==\n\n{file_path}\n\n==index==\n\n{idx}\n\n"
+                    docs_prompt_parts.append(f"\n==file name==\n\n{file_path}\n\n==index==\n\n{idx}\n\n")
             else:
-                docs_prompt += f"\n==file name==\n\n{file_path}\n\n==file content==\n\n{file_contents}\n=========\n\n"
-        return docs_prompt
+                docs_prompt_parts.append(f"\n==file name==\n\n{file_path}\n\n==file content==\n\n{file_contents}\n=========\n\n")
+        return docs_prompt_parts
     except Exception as e:
         get_logger().exception(f"Unexpected exception thrown. Returning empty result.")
-        return ""
+        return []
+
+def aggregate_documentation_files_for_prompt_contents(file_path_to_contents: dict[str, str], return_just_headings=False) -> str:
+    return ''.join(aggregate_documentation_files_for_prompt_segments(file_path_to_contents, return_just_headings))
+
+def _clean_docs_segment(segment: str) -> str:
+    # Every segment starts with a single newline and ends with two, which clean_markdown_content strips
+    return f"\n{clean_markdown_content(segment)}\n\n"
+
+def _docs_segments_prefix(docs_segments: list[str], cumulative_lengths: list[int], max_len: int) -> list[str]:
+    # The segments making up the first max_len characters of their concatenation (the last one possibly cut)
+    num_whole_segments = bisect_right(cumulative_lengths, max_len)
+    prefix_segments = docs_segments[:num_whole_segments]
+    prefix_len = cumulative_lengths[num_whole_segments - 1] if num_whole_segments else 0
+    if num_whole_segments < len(docs_segments) and max_len > prefix_len:
+        prefix_segments.append(docs_segments[num_whole_segments][:max_len - prefix_len])
+    return prefix_segments
 
 def format_markdown_q_and_a_response(question_str: str, response_str: str, relevant_sections: list[dict[str, str]],
-                                     supported_suffixes: list[str], base_url_prefix: str, base_url_suffix: str="") -> str:
+                                     supported_suffixes: tuple[str, ...], base_url_prefix: str, base_url_suffix: str="") -> str:
     try:
         base_url_prefix = base_url_prefix.strip('/') #Sanitize base_url_prefix
-        answer_str = ""
-        answer_str += f"### Question: \n{question_str}\n\n"
-        answer_str += f"### Answer:\n{response_str.strip()}\n\n"
-        answer_str += f"#### Relevant Sources:\n\n"
+        supported_suffixes = tuple(supported_suffixes) # str.endswith accepts a tuple, checking all the suffixes in one call
+        answer_parts = [
+            f"### Question: \n{question_str}\n\n",
+            f"### Answer:\n{response_str.strip()}\n\n",
+            f"#### Relevant Sources:\n\n",
+        ]
         for section in relevant_sections:
             file = section.get('file_name').lstrip('/').strip() #Remove any '/' in the beginning, since some models do it anyway
-            ext = [suffix for suffix in supported_suffixes if file.endswith(suffix)]
-            if not ext:
+            if not file.endswith(supported_suffixes):
                 get_logger().warning(f"Unsupported file extension: {file}")
                 continue
             if str(section['relevant_section_header_string']).strip():
                 markdown_header = format_markdown_header(section['relevant_section_header_string'])
                 if base_url_prefix:
-                    answer_str += f"> - {base_url_prefix}/{file}{base_url_suffix}#{markdown_header}\n"
+                    answer_parts.append(f"> - {base_url_prefix}/{file}{base_url_suffix}#{markdown_header}\n")
             else:
-                answer_str += f"> - {base_url_prefix}/{file}{base_url_suffix}\n"
-        return answer_str
+                answer_parts.append(f"> - {base_url_prefix}/{file}{base_url_suffix}\n")
+        return ''.join(answer_parts)
     except Exception as e:
         get_logger().exception(f"Unexpected exception thrown. Returning empty result.")
         return ""
 
+# Characters removed from (or, for spaces, replaced in) a header to build its anchor
+_HEADER_TRANS = str.maketrans({"'": '', "`": '', '(': '', ')': '', ',': '', '.': '', '?': '', '!': '', ' ': '-'})
+
+
 def format_markdown_header(header: str) -> str:
     try:
-        # First, strip common characters from both ends
-        cleaned = header.strip('# 💎\n')
-
-        # Define all characters to be removed/replaced in a single pass
-        replacements = {
-            "'": '',
-            "`": '',
-            '(': '',
-            ')': '',
-            ',': '',
-            '.': '',
-            '?': '',
-            '!': '',
-            ' ': '-'
-        }
-
-        # Compile regex pattern for characters to remove
-        pattern = re.compile('|'.join(map(re.escape, replacements.keys())))
-
-        # Perform replacements in a single pass and convert to lowercase
-        return pattern.sub(lambda m: replacements[m.group()], cleaned).lower()
+        # Strip common characters from both ends, then remove/replace the rest in a single pass and convert to lowercase
+        return header.strip('# 💎\n').translate(_HEADER_TRANS).lower()
     except Exception:
         get_logger().exception(f"Error while formatting markdown header", artifacts={'header': header})
         return ""
 
+# HTML comments. Removed before anything else, so the blank lines around a comment are collapsed like any others.
+_MD_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+# YAML and TOML frontmatter, only at the very beginning of the content (after the comments are removed)
+_MD_FRONTMATTER_RES = (re.compile(r'---\s*\n.*?\n---\s*\n', re.DOTALL), re.compile(r'\+\+\+\s*\n.*?\n\+\+\+\s*\n', re.DOTALL))
+# The rest of what clean_markdown_content removes, fused into a single alternation so the content is scanned once.
+# The lookahead lets the regex engine skip quickly to the few characters an alternative can start with.
+# Only the named groups listed in _MD_CLEAN_REPLACEMENTS are replaced by something other than an empty string.
+_MD_CLEAN_RE = re.compile(
+    r'(?=[<\n!])(?:'
+    r'(?P<blank_lines>\n{3,})'  # excessive blank lines (more than 2 consecutive)
+    r'|(?P<styling_tag>(?s:<div.*?>|</div>|<span.*?>|</span>))'  # HTML tags that are often used for styling only
+    r'|(?P<image>!\[.*?\]\(.*?\))'  # images, removed completely
+    r'|(?P<image_alt>!\[.*?\])'  # image alt text, which can be verbose
+    r')'
+)
+_MD_CLEAN_REPLACEMENTS = {'blank_lines': '\n\n', 'image_alt': '![]'}
+# Simple HTML tags are replaced by the content between them, except for tags whose name starts with one of these
+_MD_KEPT_TAG_PREFIXES = ('table', 'tr', 'td', 'th', 'thead', 'tbody')
+_MD_TAG_NAME_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9]*')
+
+
+def _md_clean_replacement(match: re.Match) -> str:
+    return _MD_CLEAN_REPLACEMENTS.get(match.lastgroup, '')
+
+
+def _strip_paired_html_tags(content: str) -> str:
+    """
+    Replace each simple HTML tag pair with the content between the tags, in a single left to right pass.
+
+    Gives the same result as re.sub(r'<(?!table|tr|td|th|thead|tbody)([a-zA-Z][a-zA-Z0-9]*)[^>]*>(.*?)</\\1>', r'\\2',
+    content, flags=re.DOTALL), without that pattern's backtracking: an opening tag is paired with the first closing
+    tag of its name (or of the longest prefix of its name that has one) and the content between them is not scanned again.
+
+    Args:
+        content: The markdown content
+
+    Returns:
+        The content, with the paired tags removed
+    """
+    parts = []
+    last = 0
+    # Position of the next occurrence of each closing tag looked up so far. Lookups only move forward, so a closing
+    # tag that was not found (-1) will not be found later either.
+    next_closing_tag = {}
+    start = content.find('<')
+    while start != -1:
+        name_match = _MD_TAG_NAME_RE.match(content, start + 1)
+        if name_match is None or content.startswith(_MD_KEPT_TAG_PREFIXES, start + 1):
+            start = content.find('<', start + 1)
+            continue
+        open_tag_end = content.find('>', name_match.end())
+        if open_tag_end == -1:
+            break  # no later tag can be closed either
+        name = name_match.group()
+        for name_len in range(len(name), 0, -1):
+            closing_tag = f'</{name[:name_len]}>'
+            close_start = next_closing_tag.get(closing_tag)
+            if close_start is None or (close_start != -1 and close_start <= open_tag_end):
+                close_start = content.find(closing_tag, open_tag_end + 1)
+                next_closing_tag[closing_tag] = close_start
+            if close_start != -1:
+                break
+        if close_start == -1:
+            start = content.find('<', start + 1)
+            continue
+        parts.append(content[last:start])
+        parts.append(content[open_tag_end + 1:close_start])
+        last = close_start + len(closing_tag)
+        start = content.find('<', last)
+    if not parts:
+        return content
+    parts.append(content[last:])
+    return ''.join(parts)
+
+
+@lru_cache(maxsize=1024)  # Called per doc file. The docs of a repo, and therefore their cleaned version, rarely change between questions
 def clean_markdown_content(content: str) -> str:
     """
     Remove hidden comments and unnecessary elements from markdown content to reduce size.
@@ -229,41 +344,46 @@ def clean_markdown_content(content: str) -> str:
         Cleaned markdown content
     """
     try:
-        # Remove HTML comments
-        content = re.sub(r'<!--.*?-->', '', content, flags=re.DOTALL)
-
-        # Remove frontmatter (YAML between --- or +++ delimiters)
-        content = re.sub(r'^---\s*\n.*?\n---\s*\n', '', content, flags=re.DOTALL)
-        content = re.sub(r'^\+\+\+\s*\n.*?\n\+\+\+\s*\n', '', content, flags=re.DOTALL)
-
-        # Remove excessive blank lines (more than 2 consecutive)
-        content = re.sub(r'\n{3,}', '\n\n', content)
-
-        # Remove HTML tags that are often used for styling only
-        content = re.sub(r'<div.*?>|</div>|<span.*?>|</span>', '', content, flags=re.DOTALL)
-
-        # Remove image alt text which can be verbose
-        content = re.sub(r'!\[(.*?)\]', '![]', content)
-
-        # Remove images completely
-        content = re.sub(r'!\[.*?\]\(.*?\)', '', content)
+        if '<!--' in content:
+            content = _MD_COMMENT_RE.sub('', content)
+        # A YAML frontmatter may be followed by a TOML one, and both are removed
+        for frontmatter_re in _MD_FRONTMATTER_RES:
+            frontmatter = frontmatter_re.match(content)
+            if frontmatter:
+                content = content[frontmatter.end():]
+        content = _MD_CLEAN_RE.sub(_md_clean_replacement, content)
 
         # Remove simple HTML tags but preserve content between them
-        content = re.sub(r'<(?!table|tr|td|th|thead|tbody)([a-zA-Z][a-zA-Z0-9]*)[^>]*>(.*?)</\1>',
-                         r'\2', content, flags=re.DOTALL)
+        content = _strip_paired_html_tags(content)
         return content.strip()
     except Exception as e:
         get_logger().exception(f"Unexpected exception thrown. Returning empty result.")
         return ""
 
+_JINJA_ENV = Environment(undefined=StrictUndefined)
+
+
+@lru_cache(maxsize=32)
+def _compile(template_source: str) -> Template:
+    # from_string doesn't use the environment's template cache, so the prompts would be parsed again on every call
+    return _JINJA_ENV.from_string(template_source)
+
+
 class PredictionPreparator:
     def __init__(self, ai_handler, vars, system_prompt, user_prompt):
         try:
             self.ai_handler = ai_handler
-            variables = copy.deepcopy(vars)
-            environment = Environment(undefined=StrictUndefined)
-            self.system_prompt = environment.from_string(system_prompt).render(variables)
-            self.user_prompt = environment.from_string(user_prompt).render(variables)
+            variables = dict(vars)  # Rendering only reads the values, so a shallow copy is enough
+            self.system_prompt = _compile(system_prompt).render(variables)
+            self.user_prompt = _compile(user_prompt).render(variables)
+            # The user prompt starts with the docs, which are the same for every question. Optionally mark everything
+            # up to their end as cacheable by the model provider.
+            self.user_cache_prefix_len = None
+            snippets = variables.get('snippets')
+            if snippets and get_settings().get('PR_HELP_DOCS.ENABLE_PROMPT_CACHE_MARKERS', False):
+                snippets_start = self.user_prompt.find(snippets)
+                if snippets_start >= 0:
+                    self.user_cache_prefix_len = snippets_start + len(snippets)
         except Exception as e:
             get_logger().exception(f"Caught exception during init. Setting ai_handler to None to prevent __call__.")
             self.ai_handler = None
@@ -274,8 +394,11 @@ class PredictionPreparator:
             get_logger().error("ai handler not set. Cannot invoke model!")
             raise ValueError("PredictionPreparator not initialized")
         try:
+            # Only passed when set. AI handlers that don't support prompt caching ignore it
+            cache_kwargs = {'user_cache_prefix_len': self.user_cache_prefix_len} if self.user_cache_prefix_len else {}
             response, finish_reason = await self.ai_handler.chat_completion(
-                model=model, temperature=get_settings().config.temperature, system=self.system_prompt, user=self.user_prompt)
+                model=model, temperature=get_settings().config.temperature, system=self.system_prompt, user=self.user_prompt,
+                **cache_kwargs)
             return response
         except Exception as e:
             get_logger().exception("Caught exception during prediction.", artifacts={'system': self.system_prompt, 'user': self.user_prompt})
@@ -294,10 +417,16 @@ class PRHelpDocs(object):
             self.include_root_readme_file = not(get_settings()['PR_HELP_DOCS.EXCLUDE_ROOT_README'])
             self.supported_doc_exts = get_settings()['PR_HELP_DOCS.SUPPORTED_DOC_EXTS']
             self.docs_path = get_settings()['PR_HELP_DOCS.DOCS_PATH']
+            self.docs_cache_ttl_sec = get_settings().get('PR_HELP_DOCS.DOCS_CACHE_TTL_SEC', 0)
+            self.max_doc_file_bytes = get_settings().get('PR_HELP_DOCS.MAX_DOC_FILE_BYTES', 512 * 1024)
 
             retrieved_settings = [self.include_root_readme_file, self.supported_doc_exts, self.docs_path]
             if any([setting is None for setting in retrieved_settings]):
                 raise Exception(f"One of the settings is invalid: {retrieved_settings}")
+            # Ensure extensions don't have leading dots and are lowercase
+            dotless_extensions = [ext.lower().lstrip('.') for ext in self.supported_doc_exts]
+            self._ext_suffix_tuple = tuple(f'.{ext}' for ext in dotless_extensions)
+            self._readme_file_names = frozenset(f"readme.{ext}" for ext in dotless_extensions)
 
             self.git_provider = get_git_provider_with_context(ctx_url)
             if not self.git_provider:
@@ -318,10 +447,15 @@ class PRHelpDocs(object):
                 "question": self.question,
                 "snippets": "",
             }
+            # Prompt templates are resolved from the settings once, and reused by every model invocation
+            self._system_tmpl = get_settings().pr_help_docs_prompts.system
+            self._user_tmpl = get_settings().pr_help_docs_prompts.user
+            self._headings_system_tmpl = get_settings().pr_help_docs_headings_prompts.system
+            self._headings_user_tmpl = get_settings().pr_help_docs_headings_prompts.user
             self.token_handler = TokenHandler(None,
                                                   self.vars,
-                                                  get_settings().pr_help_docs_prompts.system,
-                                                  get_settings().pr_help_docs_prompts.user)
+                                                  self._system_tmpl,
+                                                  self._user_tmpl)
         except Exception as e:
             get_logger().exception(f"Caught exception during init. Setting self.question to None to prevent run() to do anything.")
             self.question = None
@@ -333,14 +467,16 @@ class PRHelpDocs(object):
 
         try:
             # Clone the repository and gather relevant documentation files.
-            docs_filepath_to_contents = self._gen_filenames_to_contents_map_from_repo()
+            docs_filepath_to_contents = self._load_cached_docs_map()
+            if not docs_filepath_to_contents:
+                docs_filepath_to_contents = self._gen_filenames_to_contents_map_from_repo()
+                self._store_cached_docs_map(docs_filepath_to_contents)
 
             #Generate prompt for the AI model. This will be the full text of all the documentation files combined.
-            docs_prompt = aggregate_documentation_files_for_prompt_contents(docs_filepath_to_contents)
-            if not docs_filepath_to_contents or not docs_prompt:
+            docs_segments = aggregate_documentation_files_for_prompt_segments(docs_filepath_to_contents)
+            if not docs_filepath_to_contents or not docs_segments:
                 get_logger().warning(f"Could not find any usable documentation. Returning with no result...")
                 return None
-            docs_prompt_to_send_to_model = docs_prompt
 
             # Estimate how many tokens will be needed.
             # In case the expected number of tokens exceeds LLM limits, retry with just headings, asking the LLM to rank according to relevance to the question.
@@ -348,12 +484,14 @@ class PRHelpDocs(object):
 
             #First, check if the text is not too long to even query the LLM provider:
             max_allowed_txt_input = get_maximal_text_input_length_for_token_count_estimation()
-            invoke_llm_just_with_headings = self._trim_docs_input(docs_prompt_to_send_to_model, max_allowed_txt_input,
+            invoke_llm_just_with_headings = self._trim_docs_input(docs_segments, max_allowed_txt_input,
                                                                   only_return_if_trim_needed=True)
             if invoke_llm_just_with_headings:
                 #Entire docs is too long. Rank and return according to relevance.
                 docs_prompt_to_send_to_model = await self._rank_docs_and_return_them_as_prompt(docs_filepath_to_contents,
                                                                                          max_allowed_txt_input)
+            else:
+                docs_prompt_to_send_to_model = ''.join(docs_segments)
 
             if not docs_prompt_to_send_to_model:
                 get_logger().error("Failed to generate docs prompt for model. Returning with no result...")
@@ -362,8 +500,8 @@ class PRHelpDocs(object):
             self.vars['snippets'] = docs_prompt_to_send_to_model.strip()
             # Run the AI model and extract sections from its response
             response = await retry_with_fallback_models(PredictionPreparator(self.ai_handler, self.vars,
-                                                                             get_settings().pr_help_docs_prompts.system,
-                                                                             get_settings().pr_help_docs_prompts.user),
+                                                                             self._system_tmpl,
+                                                                             self._user_tmpl),
                                                         model_type=ModelType.REGULAR)
             response_yaml = load_yaml(response)
             if not response_yaml:
@@ -393,52 +531,117 @@ class PRHelpDocs(object):
         except Exception as e:
             get_logger().exception('failed to provide answer to given user question as a result of a thrown exception (see above)')
 
-    def _find_all_document_files_matching_exts(self, abs_docs_path: str, ignore_readme=False, max_allowed_files=5000) -> list[str]:
+    def _scan_files(self, dir_path: str, depth: int = 0):
+        # Yields (depth, entry) for every non directory entry under dir_path, in the same top-down order as os.walk.
+        # os.scandir returns the file type together with the names, so no extra stat call is needed per entry.
+        # Entries are sorted by name, so the order (and which files are kept when there are too many) doesn't depend
+        # on the file system.
         try:
-            matching_files = []
-
-            # Ensure extensions don't have leading dots and are lowercase
-            dotless_extensions = [ext.lower().lstrip('.') for ext in self.supported_doc_exts]
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            get_logger().debug(f"Skipping unreadable directory {dir_path}: {e}")
+            return
+        sub_dirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                yield depth, entry
+            elif not entry.is_symlink():  # Like os.walk, don't follow symlinks to directories
+                sub_dirs.append(entry.path)
+        for sub_dir in sub_dirs:
+            yield from self._scan_files(sub_dir, depth + 1)
+
+    def _find_all_document_files_matching_exts(self, abs_docs_path: str, ignore_readme=False, max_allowed_files=5000,
+                                               root_readme_files: list[str] | None = None) -> list[str]:
+        """
+        Find all the documentation files under abs_docs_path.
+
+        Args:
+            abs_docs_path: Directory to look for documentation files in
+            ignore_readme: If True, README files directly under abs_docs_path (with a supported extension) are skipped
+            max_allowed_files: Stop after finding this many files
+            root_readme_files: If given, any README.* file directly under abs_docs_path is appended to it as well,
+                               so the repository root doesn't need to be scanned again just for it
+
+        Returns:
+            List of paths of the matching files, smallest first
+        """
+        try:
+            matching_files = []  # (file size, path)
 
-            # Walk through directory and subdirectories
             file_cntr = 0
-            for root, _, files in os.walk(abs_docs_path):
-                for file in files:
-                    if ignore_readme and root == abs_docs_path and file.lower() in [f"readme.{ext}" for ext in dotless_extensions]:
+            for depth, entry in self._scan_files(abs_docs_path):
+                file_name = entry.name.lower()
+                if depth == 0:
+                    if root_readme_files is not None and file_name.startswith("readme."):
+                        root_readme_files.append(entry.path)
+                    if ignore_readme and file_name in self._readme_file_names:
+                        continue
+                # Check if file has one of the specified extensions
+                if file_name.endswith(self._ext_suffix_tuple):
+                    # Skip files that are too small to be useful, or so large (usually generated) that they would
+                    # only be trimmed, before they are opened
+                    try:
+                        file_size = entry.stat().st_size
+                    except OSError:
+                        continue
+                    if file_size < MIN_DOC_FILE_BYTES or (self.max_doc_file_bytes and file_size > self.max_doc_file_bytes):
+                        get_logger().debug(f"Skipping {entry.path} of size {file_size} bytes")
                         continue
-                    # Check if file has one of the specified extensions
-                    if any(file.lower().endswith(f'.{ext}') for ext in dotless_extensions):
-                        file_cntr+=1
-                        matching_files.append(os.path.join(root, file))
-                        if file_cntr >= max_allowed_files:
-                            get_logger().warning(f"Found at least {max_allowed_files} files in {abs_docs_path}, skipping the rest.")
-                            return matching_files
-            return matching_files
+                    file_cntr+=1
+                    matching_files.append((file_size, entry.path))
+                    if file_cntr >= max_allowed_files:
+                        get_logger().warning(f"Found at least {max_allowed_files} files in {abs_docs_path}, skipping the rest.")
+                        break
+            # Smallest files first, so more distinct files fit before the docs prompt is trimmed. Ties are ordered by
+            # path, so the docs prompt, and everything cached for it, stays the same between runs.
+            return [path for _, path in sorted(matching_files)]
         except Exception as e:
             get_logger().exception(f"Unexpected exception thrown. Returning empty list.")
             return []
 
+    def _find_root_readme_files(self, repo_root: str) -> list[str]:
+        try:
+            with os.scandir(repo_root) as it:
+                return sorted(os.path.join(repo_root, entry.name) for entry in it
+                              if entry.name.lower().startswith("readme.") and not entry.is_dir())
+        except OSError as e:
+            get_logger().warning(f"Failed to look for README files in {repo_root}: {e}")
+            return []
+
     def _gen_filenames_to_contents_map_from_repo(self) -> dict[str, str]:
         try:
             with TemporaryDirectory() as tmp_dir:
                 get_logger().debug(f"About to clone repository: {self.repo_url} to temporary directory: {tmp_dir}...")
-                returned_cloned_repo_root = self.git_provider.clone(self.repo_url, tmp_dir, remove_dest_folder=False)
+                # Only the root README files and the docs are needed, so the rest of the repo is not checked out
+                docs_dir = os.path.normpath(self.docs_path).strip('/')
+                sparse_checkout_paths = [docs_dir] if docs_dir and docs_dir != '.' else None
+                returned_cloned_repo_root = self.git_provider.clone(self.repo_url, tmp_dir, remove_dest_folder=False,
+                                                                    sparse_checkout_paths=sparse_checkout_paths)
                 if not returned_cloned_repo_root:
                     raise Exception(f"Failed to clone {self.repo_url} to {tmp_dir}")
 
                 get_logger().debug(f"About to gather relevant documentation files...")
+                repo_root = returned_cloned_repo_root.path
+                abs_docs_path = os.path.join(repo_root, self.docs_path)
+                docs_path_is_repo_root = os.path.normpath(abs_docs_path) == os.path.normpath(repo_root)
                 doc_files = []
-                if self.include_root_readme_file:
-                    for root, _, files in os.walk(returned_cloned_repo_root.path):
-                        # Only look at files in the root directory, not subdirectories
-                        if root == returned_cloned_repo_root.path:
-                            for file in files:
-                                if file.lower().startswith("readme."):
-                                    doc_files.append(os.path.join(root, file))
-                abs_docs_path = os.path.join(returned_cloned_repo_root.path, self.docs_path)
+                if self.include_root_readme_file and not docs_path_is_repo_root:
+                    doc_files = self._find_root_readme_files(repo_root)
                 if os.path.exists(abs_docs_path):
-                    doc_files.extend(self._find_all_document_files_matching_exts(abs_docs_path,
-                                                                                 ignore_readme=(self.docs_path=='.')))
+                    # When the docs are the whole repo, the root README files are found while scanning it
+                    root_readme_files = [] if self.include_root_readme_file and docs_path_is_repo_root else None
+                    found_doc_files = self._find_all_document_files_matching_exts(abs_docs_path,
+                                                                                  ignore_readme=docs_path_is_repo_root,
+                                                                                  root_readme_files=root_readme_files)
+                    if root_readme_files:
+                        # Same paths (and therefore links) as if they were looked up directly under the repo root
+                        doc_files.extend(os.path.join(repo_root, os.path.basename(f)) for f in root_readme_files)
+                    doc_files.extend(found_doc_files)
                     if not doc_files:
                         get_logger().warning(f"No documentation files found matching file extensions: "
                                              f"{self.supported_doc_exts} under repo: {self.repo_url} "
@@ -449,22 +652,81 @@ class PRHelpDocs(object):
                                   f' will be using the following documentation files: ',
                                   artifacts={'doc_files': doc_files})
 
-                return map_documentation_files_to_contents(returned_cloned_repo_root.path, doc_files)
+                return map_documentation_files_to_contents(repo_root, doc_files)
         except Exception as e:
             get_logger().exception(f"Unexpected exception thrown. Returning empty dict.")
             return {}
 
-    def _trim_docs_input(self, docs_input: str, max_allowed_txt_input: int, only_return_if_trim_needed=False) -> bool|str:
+    def _docs_cache_file_path(self) -> str:
+        # The docs rarely change between questions, so the gathered files are cached per repo, branch and search settings
+        cache_key = repr((self.repo_url, self.repo_desired_branch, self.docs_path, tuple(self.supported_doc_exts),
+                          self.include_root_readme_file, self.max_doc_file_bytes))
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pr-agent', 'help_docs')
+        return os.path.join(cache_dir, f"{hashlib.sha256(cache_key.encode('utf-8')).hexdigest()}.json")
+
+    def _load_cached_docs_map(self) -> dict[str, str]:
+        if not self.docs_cache_ttl_sec:
+            return {}
+        cache_file_path = self._docs_cache_file_path()
+        self._remove_expired_cached_docs_maps(os.path.dirname(cache_file_path))
+        try:
+            with open(cache_file_path, 'r', encoding='utf-8') as f:
+                docs_filepath_to_contents = json.load(f)
+            get_logger().debug(f"Using cached documentation files of repo: {self.repo_url} from: {cache_file_path}")
+            return docs_filepath_to_contents
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            get_logger().warning(f"Failed to load cached documentation files from: {cache_file_path}: {e}")
+            return {}
+
+    def _remove_expired_cached_docs_maps(self, cache_dir: str):
+        # Cache files are only ever replaced, never removed, so expired ones (of any repo) are deleted here
+        now = time.time()
+        try:
+            with os.scandir(cache_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith('.json'):
+                        continue
+                    try:
+                        if now - entry.stat().st_mtime >= self.docs_cache_ttl_sec:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass  # removed concurrently
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            get_logger().warning(f"Failed to remove expired cached documentation files from: {cache_dir}: {e}")
+
+    def _store_cached_docs_map(self, docs_filepath_to_contents: dict[str, str]):
+        if not self.docs_cache_ttl_sec or not docs_filepath_to_contents:
+            return
+        cache_file_path = self._docs_cache_file_path()
+        tmp_file_path = None
         try:
-            if len(docs_input) >= max_allowed_txt_input:
+            os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
+            # Write to a temporary file and rename it, so concurrent readers never see a partially written file
+            with NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(cache_file_path), suffix='.tmp',
+                                    delete=False) as f:
+                tmp_file_path = f.name
+                json.dump(docs_filepath_to_contents, f)
+            os.replace(tmp_file_path, cache_file_path)
+        except Exception as e:
+            get_logger().warning(f"Failed to cache documentation files to: {cache_file_path}: {e}")
+            if tmp_file_path and os.path.exists(tmp_file_path):
+                os.remove(tmp_file_path)
+
+    def _trim_docs_input(self, docs_segments: list[str], max_allowed_txt_input: int, only_return_if_trim_needed=False) -> bool|str:
+        try:
+            # The segments are only joined once it is known which of them are needed
+            cumulative_lengths = list(accumulate(map(len, docs_segments)))
+            docs_len = cumulative_lengths[-1] if cumulative_lengths else 0
+            if docs_len >= max_allowed_txt_input:
                 get_logger().warning(
-                    f"Text length: {len(docs_input)} exceeds the current returned limit of {max_allowed_txt_input} just for token count estimation. Trimming the text...")
+                    f"Text length: {docs_len} exceeds the current returned limit of {max_allowed_txt_input} just for token count estimation. Trimming the text...")
                 if only_return_if_trim_needed:
                     return True
-                docs_input = docs_input[:max_allowed_txt_input]
-            # Then, count the tokens in the prompt. If the count exceeds the limit, trim the text.
-            token_count = self.token_handler.count_tokens(docs_input, force_accurate=True)
-            get_logger().debug(f"Estimated token count of documentation to send to model: {token_count}")
+                docs_segments = _docs_segments_prefix(docs_segments, cumulative_lengths, max_allowed_txt_input)
             model = get_settings().config.model
             if model in MAX_TOKENS:
                 max_tokens_full = MAX_TOKENS[
@@ -472,18 +734,26 @@ class PRHelpDocs(object):
             else:
                 max_tokens_full = get_max_tokens(model)
             delta_output = 5000  # Elbow room to reduce chance of exceeding token limit or model paying less attention to prompt guidelines.
+            # Then, count the tokens in the prompt. If the count exceeds the limit, trim the text.
+            # An accurate count (which may be an API call) is only needed when the text is not obviously within the limit.
+            token_count = sum(_fast_token_estimate(segment, model) for segment in docs_segments)
+            if token_count >= FAST_TOKEN_ESTIMATE_MAX_RATIO * (max_tokens_full - delta_output):
+                token_count = self.token_handler.count_tokens(''.join(docs_segments), force_accurate=True)
+            get_logger().debug(f"Estimated token count of documentation to send to model: {token_count}")
             if token_count > max_tokens_full - delta_output:
                 if only_return_if_trim_needed:
                     return True
-                docs_input = clean_markdown_content(
-                    docs_input)  # Reduce unnecessary text/images/etc.
+                # The accurate count of the docs is reused for clipping them, so it is not thrown away
+                counted_len = sum(map(len, docs_segments))
+                # Reduce unnecessary text/images/etc. Each file is cleaned on its own, so nothing is removed across files.
+                docs_segments = [_clean_docs_segment(segment) for segment in docs_segments]
                 get_logger().info(
                     f"Token count {token_count} exceeds the limit {max_tokens_full - delta_output}. Attempting to clip text to fit within the limit...")
-                docs_input = clip_tokens(docs_input, max_tokens_full - delta_output,
-                                                           num_input_tokens=token_count)
+                return self._clip_docs_to_token_limit(docs_segments, max_tokens_full - delta_output, model,
+                                                      counted_len=counted_len, counted_tokens=token_count)
             if only_return_if_trim_needed:
                 return False
-            return docs_input
+            return ''.join(docs_segments)
         except Exception as e:
             # Unexpected exception. Rethrowing it since:
             # 1. This is an internal function.
@@ -491,14 +761,57 @@ class PRHelpDocs(object):
             get_logger().exception(f"Unexpected exception thrown. Rethrowing it...")
             raise e
 
+    def _clip_docs_to_token_limit(self, docs_segments: list[str], max_tokens: int, model: str,
+                                  counted_len: int = None, counted_tokens: int = None) -> str:
+        """
+        Clip the docs to the longest prefix that fits within max_tokens, using at most 2 accurate token counts.
+
+        The characters per token ratio of the docs gives the prefix length to keep. It comes from counted_len and
+        counted_tokens when given (a count the caller already made, e.g. of the docs before they were cleaned), or else
+        from a first accurate count. A second count checks the prefix, and if it is still over the limit, the prefix is
+        shrunk by the measured overshoot. That last prefix is not counted again, so when the token density keeps
+        growing along the docs, it may still exceed max_tokens by a few tokens.
+
+        Args:
+            docs_segments: The (already cleaned) documentation text, as segments
+            max_tokens: The maximal number of tokens allowed
+            model: The model the docs are sent to
+            counted_len: Length of a text with the same token density as the docs, whose tokens were already counted
+            counted_tokens: The accurate token count of that text
+
+        Returns:
+            The clipped docs, ending with a truncation marker if anything was clipped
+        """
+        if max_tokens <= 0:
+            return ""
+        docs_input = ''.join(docs_segments)
+        if sum(_fast_token_estimate(segment, model) for segment in docs_segments) < FAST_TOKEN_ESTIMATE_MAX_RATIO * max_tokens:
+            return docs_input  # Cleaning alone was enough
+        if not counted_len or not counted_tokens:
+            counted_len = len(docs_input)
+            counted_tokens = self.token_handler.count_tokens(docs_input, force_accurate=True)
+            if counted_tokens <= max_tokens:
+                return docs_input
+        safety_factor = 0.95  # Token density varies along the text, so aim a little below the limit
+        clipped_len = int(safety_factor * counted_len * max_tokens / counted_tokens)
+        clipped_docs = docs_input[:clipped_len]
+        clipped_token_count = self.token_handler.count_tokens(clipped_docs, force_accurate=True)
+        if clipped_token_count > max_tokens:
+            clipped_docs = clipped_docs[:int(safety_factor * len(clipped_docs) * max_tokens / clipped_token_count)]
+        elif len(clipped_docs) == len(docs_input):
+            return docs_input  # The cleaned docs fit as a whole
+        # Don't end in the middle of a line
+        clipped_docs = clipped_docs.rsplit('\n', 1)[0]
+        get_logger().debug(f"Clipped docs from {len(docs_input)} to {len(clipped_docs)} characters to fit {max_tokens} tokens")
+        return clipped_docs + "\n...(truncated)"
+
     async def _rank_docs_and_return_them_as_prompt(self, docs_filepath_to_contents: dict[str, str], max_allowed_txt_input: int) -> str:
         try:
             #Return just file name and their headings (if exist):
-            docs_prompt_to_send_to_model = (
-                aggregate_documentation_files_for_prompt_contents(docs_filepath_to_contents,
-                                                                  return_just_headings=True))
+            docs_segments = aggregate_documentation_files_for_prompt_segments(docs_filepath_to_contents,
+                                                                              return_just_headings=True)
             # Verify list of headings does not exceed limits - trim it if it does.
-            docs_prompt_to_send_to_model = self._trim_docs_input(docs_prompt_to_send_to_model, max_allowed_txt_input,
+            docs_prompt_to_send_to_model = self._trim_docs_input(docs_segments, max_allowed_txt_input,
                                                                  only_return_if_trim_needed=False)
             if not docs_prompt_to_send_to_model:
                 get_logger().error("_trim_docs_input returned an empty result.")
@@ -507,8 +820,8 @@ class PRHelpDocs(object):
             self.vars['snippets'] = docs_prompt_to_send_to_model.strip()
             # Run the AI model and extract sections from its response
             response = await retry_with_fallback_models(PredictionPreparator(self.ai_handler, self.vars,
-                                                                             get_settings().pr_help_docs_headings_prompts.system,
-                                                                             get_settings().pr_help_docs_headings_prompts.user),
+                                                                             self._headings_system_tmpl,
+                                                                             self._headings_user_tmpl),
                                                         model_type=ModelType.REGULAR)
             response_yaml = load_yaml(response)
             if not response_yaml:
@@ -519,11 +832,10 @@ class PRHelpDocs(object):
                              if int(entry['idx']) >= 0 and int(entry['idx']) < len(docs_filepath_to_contents)]
             valid_file_paths = [list(docs_filepath_to_contents.keys())[idx] for idx in valid_indices]
             selected_docs_dict = {file_path: docs_filepath_to_contents[file_path] for file_path in valid_file_paths}
-            docs_prompt = aggregate_documentation_files_for_prompt_contents(selected_docs_dict)
-            docs_prompt_to_send_to_model = docs_prompt
+            docs_segments = aggregate_documentation_files_for_prompt_segments(selected_docs_dict)
 
             # Check if the updated list of documents does not exceed limits and trim if it does:
-            docs_prompt_to_send_to_model = self._trim_docs_input(docs_prompt_to_send_to_model, max_allowed_txt_input,
+            docs_prompt_to_send_to_model = self._trim_docs_input(docs_segments, max_allowed_txt_input,
                                                                  only_return_if_trim_needed=False)
             if not docs_prompt_to_send_to_model:
                 get_logger().error("_trim_docs_input returned an empty result.")
@@ -539,7 +851,7 @@ class PRHelpDocs(object):
                 self.git_provider.get_canonical_url_parts(repo_git_url=self.repo_url if self.repo_url_given_explicitly else None,
                                                           desired_branch=self.repo_desired_branch))
             answer_str = format_markdown_q_and_a_response(self.question, response_str, relevant_sections,
-                                                          self.supported_doc_exts, canonical_url_prefix, canonical_url_suffix)
+                                                          self._ext_suffix_tuple, canonical_url_prefix, canonical_url_suffix)
             if answer_str:
                 #Remove the question phrase and replace with light bulb and a heading mentioning this is an automated answer:
                 answer_str = modify_answer_section(answer_str)
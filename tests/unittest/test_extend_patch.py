@@ -154,6 +154,8 @@ class TestExtendedPatchMoreLines:
         p1 = patches_extended_no_extra_lines[1].strip()
         assert p0 == "## File: 'file1'\n\n" + pr_languages[0]['files'][0].patch.strip()
         assert p1 == "## File: 'file2'\n\n" + pr_languages[0]['files'][1].patch.strip()
+        assert isinstance(patches_extended_tokens, list)
+        assert total_tokens == token_handler.prompt_tokens + sum(patches_extended_tokens)
 
         patches_extended_with_extra_lines, total_tokens, patches_extended_tokens = pr_generate_extended_diff(
             pr_languages, token_handler, add_line_numbers_to_hunks=False,
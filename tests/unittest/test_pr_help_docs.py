@@ -0,0 +1,356 @@
+import asyncio
+import os
+
+import pytest
+
+from pr_agent.algo import MAX_TOKENS
+from pr_agent.config_loader import get_settings
+from pr_agent.tools.pr_help_docs import (PredictionPreparator, PRHelpDocs, _clean_docs_segment, _docs_segments_prefix,
+                                         _fast_token_estimate, aggregate_documentation_files_for_prompt_contents,
+                                         aggregate_documentation_files_for_prompt_segments, clean_markdown_content,
+                                         extract_model_answer_and_relevant_sources, format_markdown_header,
+                                         format_markdown_q_and_a_response, map_documentation_files_to_contents)
+
+
+class TestCleanMarkdownContent:
+    @pytest.mark.parametrize("content, expected", [
+        ("---\ntitle: Intro\n---\n# Intro\n\nSome text.", "# Intro\n\nSome text."),
+        ("+++\ntitle = 'Intro'\n+++\n# Intro", "# Intro"),
+        ("# Title\n<!-- hidden\ncomment -->\nVisible", "# Title\n\nVisible"),
+        ("a\n\n\n\n\nb", "a\n\nb"),
+        ("<div class=\"note\">\nNote text\n</div>\n<span style='x'>inline</span>", "Note text\n\ninline"),
+        ("See ![diagram of the flow](img/flow.png) here.", "See  here."),
+        ("Reference ![alt text] only.", "Reference ![] only."),
+        ("<b>bold</b> and <table><tr><td>cell</td></tr></table>",
+         "bold and <table><tr><td>cell</td></tr></table>"),
+        ("<details><summary>More</summary>hidden</details>", "<summary>More</summary>hidden"),
+        ("Text with --- in the middle\n---\nnot frontmatter\n---\n",
+         "Text with --- in the middle\n---\nnot frontmatter\n---"),
+        ("  \n\nPadded\n\n  ", "Padded"),
+        ("a\n\n<!--x-->\n\nb", "a\n\nb"),
+        ("---\ntitle: Intro\n---\n+++\ntitle = 'Intro'\n+++\n# Intro", "# Intro"),
+        ("<!-- generated -->---\ntitle: Intro\n---\n# Intro", "# Intro"),
+        ("<bold>text</b> <i>unclosed <em>x</em>", "text <i>unclosed x"),
+        ("<b>outer <i>inner</i></b> <track>kept</track>", "outer <i>inner</i> <track>kept</track>"),
+    ])
+    def test_clean_markdown_content(self, content, expected):
+        assert clean_markdown_content(content) == expected
+
+    def test_many_unclosed_tags(self):
+        # Used to backtrack over the whole content for every opening tag
+        assert clean_markdown_content("<b>A" * 100_000 + "</b>") == "A" + "<b>A" * 99_999
+
+
+class TestExtractModelAnswerAndRelevantSources:
+    @pytest.mark.parametrize("ai_response, expected", [
+        ("### Question: \nQ?\n\n### Answer:\nUse /review\n\n#### Relevant Sources:\n\n- a.md",
+         "Use /review\n\n#### Relevant Sources:\n\n- a.md"),
+        ("### Answer:\nfirst\n### Answer:\nlast\n#### Relevant Sources:\n\n", "last\n#### Relevant Sources:\n\n"),
+        ("### Answer:\n#### Relevant Sources:\n\n- a.md", None),
+        ("### Answer:\nNo sources", None),
+        ("No answer", None),
+    ])
+    def test_extract_model_answer_and_relevant_sources(self, ai_response, expected):
+        assert extract_model_answer_and_relevant_sources(ai_response) == expected
+
+
+class TestFormatMarkdownHeader:
+    @pytest.mark.parametrize("header, expected", [
+        ("## Getting started?", "getting-started"),
+        ("### 💎 Auto-approve (beta)", "auto-approve-beta"),
+        ("# What's `new`, really!\n", "whats-new-really"),
+        ("Plain", "plain"),
+    ])
+    def test_format_markdown_header(self, header, expected):
+        assert format_markdown_header(header) == expected
+
+
+class TestFormatMarkdownQAndAResponse:
+    def test_format_markdown_q_and_a_response(self):
+        relevant_sections = [
+            {"file_name": "/docs/usage.md", "relevant_section_header_string": "## Getting started"},
+            {"file_name": "docs/index.rst", "relevant_section_header_string": ""},
+            {"file_name": "docs/image.png", "relevant_section_header_string": "## Image"},
+        ]
+        answer_str = format_markdown_q_and_a_response("How to start?", " Run it. ", relevant_sections,
+                                                      (".md", ".rst"), "https://host/repo/", "?plain=1")
+        assert answer_str == ("### Question: \nHow to start?\n\n"
+                              "### Answer:\nRun it.\n\n"
+                              "#### Relevant Sources:\n\n"
+                              "> - https://host/repo/docs/usage.md?plain=1#getting-started\n"
+                              "> - https://host/repo/docs/index.rst?plain=1\n")
+
+
+class TestPredictionPreparator:
+    def test_prompts_are_rendered(self):
+        vars = {"question": "How to start?", "snippets": "docs"}
+        for _ in range(2):
+            prediction_preparator = PredictionPreparator(object(), vars, "Docs: {{ snippets }}", "Q: {{ question }}")
+            assert prediction_preparator.system_prompt == "Docs: docs"
+            assert prediction_preparator.user_prompt == "Q: How to start?"
+
+    def test_undefined_variable(self):
+        assert PredictionPreparator(object(), {}, "{{ missing }}", "user").ai_handler is None
+
+    def test_cache_prefix_ends_after_snippets(self, monkeypatch):
+        vars = {"question": "How to start?", "snippets": "the docs"}
+        user_prompt = "Docs:\n{{ snippets|trim }}\nQ: {{ question }}"
+        assert PredictionPreparator(object(), vars, "system", user_prompt).user_cache_prefix_len is None
+        monkeypatch.setattr(get_settings().pr_help_docs, "enable_prompt_cache_markers", True)
+        prediction_preparator = PredictionPreparator(object(), vars, "system", user_prompt)
+        assert prediction_preparator.user_prompt[:prediction_preparator.user_cache_prefix_len] == "Docs:\nthe docs"
+
+    def test_cache_prefix_with_openai_handler(self, monkeypatch):
+        from pr_agent.algo.ai_handlers import openai_ai_handler
+
+        class FakeAsyncOpenAI:
+            def __init__(self):
+                self.chat = self.completions = self
+
+            async def create(self, model, messages, temperature):
+                class Message:
+                    content = f"answer to: {messages[1]['content']}"
+                class Choice:
+                    message = Message()
+                    finish_reason = "stop"
+                class Response:
+                    choices = [Choice()]
+                    usage = None
+                return Response()
+
+        monkeypatch.setattr(openai_ai_handler, "AsyncOpenAI", FakeAsyncOpenAI)
+        monkeypatch.setattr(get_settings().pr_help_docs, "enable_prompt_cache_markers", True)
+        vars = {"question": "How to start?", "snippets": "the docs"}
+        prediction_preparator = PredictionPreparator(openai_ai_handler.OpenAIHandler.__new__(openai_ai_handler.OpenAIHandler),
+                                                     vars, "system", "Docs:\n{{ snippets }}\nQ: {{ question }}")
+        assert prediction_preparator.user_cache_prefix_len
+        response = asyncio.run(prediction_preparator("gpt-4o"))
+        assert response == "answer to: Docs:\nthe docs\nQ: How to start?"
+
+
+class TestMapDocumentationFilesToContents:
+    def test_contents_keep_the_files_order(self, tmp_path):
+        doc_files = []
+        for name, content in [("b.md", "# B\n"), ("numbers.md", "1 2 3"), ("a.md", "A" * 10), ("c.md", "C")]:
+            (tmp_path / name).write_text(content)
+            doc_files.append(str(tmp_path / name))
+        doc_files.append(str(tmp_path / "missing.md"))
+        contents = map_documentation_files_to_contents(str(tmp_path), doc_files, max_allowed_file_len=5)
+        assert contents == {"/b.md": "# B", "/a.md": "AAAAA", "/c.md": "C"}
+        assert list(contents) == ["/b.md", "/a.md", "/c.md"]
+
+    def test_no_files(self):
+        assert map_documentation_files_to_contents("/repo", []) == {}
+
+    def test_binary_and_non_text_files_are_skipped(self, tmp_path):
+        (tmp_path / "binary.md").write_bytes(bytes(range(128, 256)))
+        (tmp_path / "invalid.md").write_bytes(b"text \xff")
+        (tmp_path / "windows.md").write_bytes(b"# Title\r\nLine\rEnd")
+        doc_files = [str(tmp_path / name) for name in ["binary.md", "invalid.md", "windows.md"]]
+        assert map_documentation_files_to_contents(str(tmp_path), doc_files) == {"/windows.md": "# Title\nLine\nEnd"}
+
+
+class TestAggregateDocumentationFiles:
+    def test_file_contents(self):
+        docs_prompt = aggregate_documentation_files_for_prompt_contents({"/a.md": "# A\n", "/empty.md": " ", "/b.md": "B"})
+        assert docs_prompt == ("\n==file name==\n\n/a.md\n\n==file content==\n\n# A\n=========\n\n"
+                               "\n==file name==\n\n/b.md\n\n==file content==\n\nB\n=========\n\n")
+
+    def test_just_headings(self):
+        docs_prompt = aggregate_documentation_files_for_prompt_contents({"/a.md": "# A\ntext", "/b.md": "no headings"},
+                                                                        return_just_headings=True)
+        assert docs_prompt == ("\n==file name==\n\n/a.md\n\n==index==\n\n0\n\n==file headings==\n\n# A\n=========\n\n"
+                               "\n==file name==\n\n/b.md\n\n==index==\n\n1\n\n")
+
+
+class TestFindDocumentFiles:
+    class FakeGitProvider:
+        def __init__(self, repo_root):
+            self.repo_root = repo_root
+            self.sparse_checkout_paths = []
+
+        def clone(self, repo_url, dest_folder, remove_dest_folder=True, sparse_checkout_paths=None):
+            self.sparse_checkout_paths.append(sparse_checkout_paths)
+            class ClonedRepo:
+                path = str(self.repo_root)
+            return ClonedRepo()
+
+    @pytest.fixture
+    def repo_root(self, tmp_path):
+        (tmp_path / "README.md").write_text("# Root readme")
+        (tmp_path / "readme.txt").write_text("Root readme, as text")
+        (tmp_path / "setup.py").write_text("print('not docs')")
+        (tmp_path / "docs" / "guide").mkdir(parents=True)
+        (tmp_path / "docs" / "index.md").write_text("# Index\n\nThe documentation index.")
+        (tmp_path / "docs" / "README.md").write_text("# Docs readme\n\nHow the docs are organised, and where to start.")
+        (tmp_path / "docs" / "guide" / "usage.MDX").write_text("# Usage\n\nHow to use it.")
+        (tmp_path / "docs" / "guide" / "empty.md").write_text("# Empty")
+        (tmp_path / "docs" / "guide" / "generated.md").write_text("# Generated\n" + "x" * 2000)
+        (tmp_path / "docs" / "guide" / "notes.txt").write_text("Not a doc")
+        return tmp_path
+
+    def make_help_docs(self, repo_root, docs_path, include_root_readme_file=True):
+        help_docs = PRHelpDocs.__new__(PRHelpDocs)
+        help_docs.ctx_url = help_docs.repo_url = "https://example.com/repo"
+        help_docs.git_provider = self.FakeGitProvider(repo_root)
+        help_docs.docs_path = docs_path
+        help_docs.include_root_readme_file = include_root_readme_file
+        help_docs.supported_doc_exts = [".md", "mdx", ".rst"]
+        help_docs._ext_suffix_tuple = (".md", ".mdx", ".rst")
+        help_docs._readme_file_names = frozenset({"readme.md", "readme.mdx", "readme.rst"})
+        help_docs.max_doc_file_bytes = 1000
+        return help_docs
+
+    def test_docs_dir(self, repo_root):
+        contents = self.make_help_docs(repo_root, "docs")._gen_filenames_to_contents_map_from_repo()
+        assert sorted(contents) == ["/README.md", "/docs/README.md", "/docs/guide/usage.MDX", "/docs/index.md",
+                                    "/readme.txt"]
+
+    def test_docs_dir_without_root_readme(self, repo_root):
+        help_docs = self.make_help_docs(repo_root, "docs", include_root_readme_file=False)
+        contents = help_docs._gen_filenames_to_contents_map_from_repo()
+        assert sorted(contents) == ["/docs/README.md", "/docs/guide/usage.MDX", "/docs/index.md"]
+
+    def test_whole_repo_is_scanned_once(self, repo_root, monkeypatch):
+        help_docs = self.make_help_docs(repo_root, ".")
+        monkeypatch.setattr(help_docs, "_find_root_readme_files", None)
+        contents = help_docs._gen_filenames_to_contents_map_from_repo()
+        assert sorted(contents) == ["/./docs/README.md", "/./docs/guide/usage.MDX", "/./docs/index.md",
+                                    "/README.md", "/readme.txt"]
+
+    def test_whole_repo_without_root_readme(self, repo_root):
+        help_docs = self.make_help_docs(repo_root, ".", include_root_readme_file=False)
+        contents = help_docs._gen_filenames_to_contents_map_from_repo()
+        assert sorted(contents) == ["/./docs/README.md", "/./docs/guide/usage.MDX", "/./docs/index.md"]
+
+    @pytest.mark.parametrize("docs_path, sparse_checkout_paths", [
+        ("docs", ["docs"]), ("./docs/", ["docs"]), (".", None), ("./", None),
+    ])
+    def test_only_docs_are_checked_out(self, repo_root, docs_path, sparse_checkout_paths):
+        help_docs = self.make_help_docs(repo_root, docs_path)
+        help_docs._gen_filenames_to_contents_map_from_repo()
+        assert help_docs.git_provider.sparse_checkout_paths == [sparse_checkout_paths]
+
+    def test_files_are_sorted_by_size(self, repo_root):
+        contents = self.make_help_docs(repo_root, "docs")._gen_filenames_to_contents_map_from_repo()
+        assert list(contents) == ["/README.md", "/readme.txt", "/docs/guide/usage.MDX", "/docs/index.md",
+                                  "/docs/README.md"]
+
+    def test_size_limits(self, repo_root):
+        help_docs = self.make_help_docs(repo_root, "docs")
+        help_docs.max_doc_file_bytes = 0
+        doc_files = help_docs._find_all_document_files_matching_exts(str(repo_root / "docs"))
+        assert [os.path.basename(f) for f in doc_files] == ["usage.MDX", "index.md", "README.md", "generated.md"]
+
+    def test_max_allowed_files(self, repo_root):
+        help_docs = self.make_help_docs(repo_root, "docs")
+        assert len(help_docs._find_all_document_files_matching_exts(str(repo_root / "docs"), max_allowed_files=2)) == 2
+
+
+class TestDocsCache:
+    @pytest.fixture
+    def help_docs(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+        help_docs = PRHelpDocs.__new__(PRHelpDocs)
+        help_docs.repo_url = "https://example.com/repo"
+        help_docs.repo_desired_branch = "main"
+        help_docs.docs_path = "docs"
+        help_docs.supported_doc_exts = [".md"]
+        help_docs.include_root_readme_file = True
+        help_docs.docs_cache_ttl_sec = 60
+        help_docs.max_doc_file_bytes = 1000
+        return help_docs
+
+    def test_cached_docs_are_loaded(self, help_docs):
+        assert help_docs._load_cached_docs_map() == {}
+        help_docs._store_cached_docs_map({"/docs/b.md": "B", "/docs/a.md": "A"})
+        assert list(help_docs._load_cached_docs_map().items()) == [("/docs/b.md", "B"), ("/docs/a.md", "A")]
+
+    def test_key_depends_on_settings(self, help_docs):
+        help_docs._store_cached_docs_map({"/docs/a.md": "A"})
+        help_docs.docs_path = "other_docs"
+        assert help_docs._load_cached_docs_map() == {}
+
+    def test_expired_cache_is_ignored(self, help_docs):
+        help_docs._store_cached_docs_map({"/docs/a.md": "A"})
+        os.utime(help_docs._docs_cache_file_path(), (0, 0))
+        assert help_docs._load_cached_docs_map() == {}
+        assert not os.path.exists(help_docs._docs_cache_file_path())
+
+    def test_expired_caches_of_other_repos_are_removed(self, help_docs):
+        help_docs._store_cached_docs_map({"/docs/a.md": "A"})
+        other_cache_file_path = help_docs._docs_cache_file_path()
+        os.utime(other_cache_file_path, (0, 0))
+        help_docs.repo_url = "https://example.com/other_repo"
+        help_docs._store_cached_docs_map({"/docs/b.md": "B"})
+        assert help_docs._load_cached_docs_map() == {"/docs/b.md": "B"}
+        assert not os.path.exists(other_cache_file_path)
+
+    def test_disabled_cache(self, help_docs):
+        help_docs.docs_cache_ttl_sec = 0
+        help_docs._store_cached_docs_map({"/docs/a.md": "A"})
+        assert not os.path.exists(help_docs._docs_cache_file_path())
+
+
+class TestTrimDocsInput:
+    class FakeTokenHandler:
+        def __init__(self):
+            self.calls = 0
+
+        def count_tokens(self, patch, force_accurate=False):
+            self.calls += 1
+            return len(patch) // 4
+
+    @pytest.fixture
+    def help_docs(self):
+        help_docs = PRHelpDocs.__new__(PRHelpDocs)
+        help_docs.token_handler = self.FakeTokenHandler()
+        return help_docs
+
+    def test_fast_token_estimate(self):
+        assert _fast_token_estimate("a" * 10, "gpt-4o") == 3
+        assert _fast_token_estimate("a" * 7, "anthropic/claude-3-7-sonnet-20250219") == 2
+        assert _fast_token_estimate("日本語", "gpt-4o") == 9
+        assert _fast_token_estimate("ok 👍", "gpt-4o") == 7
+
+    def test_small_docs_skip_accurate_count(self, help_docs):
+        assert help_docs._trim_docs_input(["small docs"], 1_000_000, only_return_if_trim_needed=True) is False
+        assert help_docs.token_handler.calls == 0
+
+    def test_large_docs_are_counted_accurately(self, help_docs):
+        assert help_docs._trim_docs_input(["a" * 1_000_000], 2_000_000, only_return_if_trim_needed=True) is True
+        assert help_docs.token_handler.calls == 1
+
+    def test_clip_docs_to_token_limit(self, help_docs):
+        docs = "\n".join(f"line {i} " + "x" * (i % 50) for i in range(20_000))
+        clipped_docs = help_docs._clip_docs_to_token_limit([docs], 10_000, "gpt-4o")
+        assert clipped_docs.endswith("\n...(truncated)")
+        assert docs.startswith(clipped_docs[:-len("\n...(truncated)")])
+        assert 9_000 <= help_docs.token_handler.count_tokens(clipped_docs) <= 10_000
+        assert help_docs.token_handler.calls == 3  # 2 while clipping, and 1 above
+
+    def test_trim_makes_at_most_two_accurate_counts(self, help_docs):
+        docs_segments = aggregate_documentation_files_for_prompt_segments(
+            {f"/{i}.md": "\n".join(f"line {j} <!-- comment -->" for j in range(1_000)) for i in range(100)})
+        max_tokens = MAX_TOKENS[get_settings().config.model] - 5000
+        docs_prompt = help_docs._trim_docs_input(docs_segments, 100_000_000)
+        assert docs_prompt.endswith("\n...(truncated)")
+        assert help_docs.token_handler.calls == 2  # the docs before cleaning, and the clipped prefix
+        assert 0.9 * max_tokens <= help_docs.token_handler.count_tokens(docs_prompt) <= max_tokens
+
+    def test_docs_within_limit_are_not_clipped(self, help_docs):
+        assert help_docs._clip_docs_to_token_limit(["short docs"], 10_000, "gpt-4o") == "short docs"
+
+    def test_oversized_docs_are_cleaned_per_file(self, help_docs, monkeypatch):
+        monkeypatch.setattr(help_docs, "_clip_docs_to_token_limit", lambda docs_segments, max_tokens, model, **kwargs: docs_segments)
+        docs_segments = aggregate_documentation_files_for_prompt_segments({"/a.md": "<b>" + "A" * 1_000_000, "/b.md": "B</b>"})
+        cleaned_segments = help_docs._trim_docs_input(docs_segments, 10_000_000)
+        assert cleaned_segments == [_clean_docs_segment(segment) for segment in docs_segments]
+        assert cleaned_segments[1] == "\n==file name==\n\n/b.md\n\n==file content==\n\nB</b>\n=========\n\n"
+
+    def test_long_docs_are_cut_to_max_text_length(self, help_docs):
+        assert help_docs._trim_docs_input(["abc", "def", "ghi"], 5) == "abcde"
+
+    @pytest.mark.parametrize("max_len, expected", [(0, []), (2, ["ab"]), (3, ["abc"]), (4, ["abc", "d"]), (9, ["abc", "def"])])
+    def test_docs_segments_prefix(self, max_len, expected):
+        assert _docs_segments_prefix(["abc", "def"], [3, 6], max_len) == expected
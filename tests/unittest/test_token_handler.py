@@ -0,0 +1,220 @@
+import anthropic
+import pytest
+
+import pr_agent.algo.token_handler as token_handler_module
+from pr_agent.algo.token_handler import TokenEncoderAdapter, TokenHandler, _utf8_length_exceeds
+
+
+class FakeEncoder:
+    """Splits on whitespace, and records every string it was asked to encode."""
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, text, disallowed_special=()):
+        self.calls.append(text)
+        return text.split()
+
+
+class TestTokenEncoderAdapter:
+    def test_count_falls_back_to_encode(self):
+        adapter = TokenEncoderAdapter(FakeEncoder())
+        assert adapter.count("one two three") == 3
+        assert adapter.encode("one two") == ["one", "two"]
+
+    def test_count_uses_native_counter(self):
+        class CountingEncoder(FakeEncoder):
+            def count(self, text):
+                return 42
+
+        assert TokenEncoderAdapter(CountingEncoder()).count("one two three") == 42
+
+    def test_count_prefers_encode_ordinary(self):
+        class OrdinaryEncoder(FakeEncoder):
+            def encode_ordinary(self, text):
+                return list(text)
+
+        assert TokenEncoderAdapter(OrdinaryEncoder()).count("one two") == 7
+
+
+class TestCountTokens:
+    @pytest.fixture
+    def encoder(self, monkeypatch):
+        fake_encoder = FakeEncoder()
+        adapter = TokenEncoderAdapter(fake_encoder)
+        monkeypatch.setattr(token_handler_module, "_get_encoder", lambda model: adapter)
+        TokenHandler.clear_cache()
+        yield fake_encoder
+        TokenHandler.clear_cache()
+
+    def test_count_tokens(self, encoder):
+        token_handler = TokenHandler()
+        assert token_handler.count_tokens("one two three") == 3
+
+    def test_repeated_patch_is_encoded_once(self, encoder):
+        token_handler = TokenHandler()
+        assert token_handler.count_tokens("one two three") == 3
+        assert token_handler.count_tokens("one two three") == 3
+        assert encoder.calls == ["one two three"]
+
+    def test_clear_cache(self, encoder):
+        token_handler = TokenHandler()
+        token_handler.count_tokens("one two three")
+        TokenHandler.clear_cache()
+        token_handler.count_tokens("one two three")
+        assert encoder.calls == ["one two three", "one two three"]
+
+    def test_cache_is_keyed_by_model(self, encoder):
+        token_handler = TokenHandler()
+        other_model_token_handler = TokenHandler()
+        other_model_token_handler._model = token_handler._model + "-other"
+        assert token_handler.count_tokens("one two three") == 3
+        assert other_model_token_handler.count_tokens("one two three") == 3
+        assert encoder.calls == ["one two three", "one two three"]
+
+    def test_cache_is_bounded(self, encoder, monkeypatch):
+        monkeypatch.setattr(TokenHandler, "L0_MAX_ENTRIES", 2)
+        token_handler = TokenHandler()
+        for patch in ["one", "two", "three"]:
+            token_handler.count_tokens(patch)
+        assert len(TokenHandler._l0) == 2
+        token_handler.count_tokens("one")  # the oldest entry was evicted
+        assert encoder.calls == ["one", "two", "three", "one"]
+
+    def test_growing_prompt_only_encodes_new_suffix(self, encoder):
+        token_handler = TokenHandler()
+        base_prompt = "system prompt\n---\nstatic context"
+        assert token_handler.count_tokens(base_prompt + "\n---\nfirst question") == 8
+        assert token_handler.count_tokens(base_prompt + "\n---\nsecond question") == 8
+        assert encoder.calls[-1] == "---\nsecond question"
+
+    @pytest.mark.parametrize("text, segments", [
+        ("text.\n\n### Header", ["text.\n\n", "### Header"]),
+        ("intro\n---\nbody", ["intro\n", "---\nbody"]),
+        ("\n---\nbody", ["\n", "---\nbody"]),
+        ("prompt<|system|>rest", ["prompt<|system|>rest"]),  # not preceded by a newline
+        ("prompt\n<|system|>rest", ["prompt\n", "<|system|>rest"]),
+    ])
+    def test_prompt_is_split_after_newlines(self, encoder, text, segments):
+        TokenHandler().count_tokens(text)
+        assert encoder.calls == segments
+
+    def test_empty_patch_is_not_encoded(self, encoder):
+        assert TokenHandler().count_tokens("") == 0
+        assert TokenHandler().count_tokens("", force_accurate=True) == 0
+        assert encoder.calls == []
+
+    def test_count_tokens_batch(self, encoder):
+        token_handler = TokenHandler()
+        assert token_handler.count_tokens_batch(["one", "one two", ""]) == [1, 2, 0]
+        assert token_handler.count_tokens_batch([]) == []
+
+    def test_count_many(self, encoder):
+        counts = TokenHandler().count_many(["one", "", "one two"])
+        assert list(counts) == [1, 0, 2]
+        assert sum(counts) == 3
+        assert encoder.calls == ["one", "one two"]
+
+    def test_count_many_shares_the_cache(self, encoder):
+        token_handler = TokenHandler()
+        assert token_handler.count_tokens("one") == 1
+        assert list(token_handler.count_many(["one", "one two", "one two"])) == [1, 2, 2]
+        assert encoder.calls == ["one", "one two", "one two"]  # both misses are sent in the same batch
+        assert list(token_handler.count_many(["one two"])) == [2]
+        assert token_handler.count_tokens("one two") == 2
+        assert encoder.calls == ["one", "one two", "one two"]
+
+
+class TestSystemUserTokens:
+    @pytest.fixture
+    def encoder(self, monkeypatch):
+        fake_encoder = FakeEncoder()
+        adapter = TokenEncoderAdapter(fake_encoder)
+        monkeypatch.setattr(token_handler_module, "_get_encoder", lambda model: adapter)
+        yield fake_encoder
+
+    def test_prompts_are_rendered(self, encoder):
+        token_handler = TokenHandler(pr=object(), vars={"title": "fix the bug"},
+                                     system="You review code", user="Title: {{ title }}")
+        assert token_handler.prompt_tokens == 3 + 4
+        assert encoder.calls == ["You review code", "Title: fix the bug"]
+
+    def test_undefined_variable_counts_zero(self, encoder):
+        token_handler = TokenHandler(pr=object(), vars={}, system="system", user="{{ missing }}")
+        assert token_handler.prompt_tokens == 0
+
+    def test_plain_prompts_skip_jinja(self, encoder, monkeypatch):
+        monkeypatch.setattr(TokenHandler, "_compile_template", None)
+        token_handler = TokenHandler(pr=object(), vars={}, system="You review code\n", user="Plain user prompt")
+        assert token_handler.prompt_tokens == 3 + 3
+        assert encoder.calls == ["You review code", "Plain user prompt"]
+
+
+class TestL0Key:
+    class FakeXxh3:
+        def __init__(self, data=b""):
+            self.updates = [data]
+
+        def update(self, data):
+            self.updates.append(data)
+
+        def intdigest(self):
+            return hash(b"".join(self.updates))
+
+    def test_text_is_hashed_in_slices(self, monkeypatch):
+        hashers = []
+        def xxh3_64(data):
+            hashers.append(self.FakeXxh3(data))
+            return hashers[-1]
+        monkeypatch.setattr(token_handler_module, "XXHASH_AVAILABLE", True)
+        monkeypatch.setattr(token_handler_module, "xxhash", type("xxhash", (), {"xxh3_64": staticmethod(xxh3_64)}),
+                            raising=False)
+        monkeypatch.setattr(token_handler_module, "L0_HASH_CHUNK_CHARS", 4)
+        text = "abcdéfghij"
+        key = token_handler_module._l0_key("model", text)
+        assert [len(data) for data in hashers[0].updates[1:]] == [4, 5, 2]  # "abcd", "éfgh" (é is 2 bytes), "ij"
+        assert key == hash(b"model\0" + text.encode("utf-8"))
+
+
+class TestUtf8LengthExceeds:
+    @pytest.mark.parametrize("text, max_bytes", [
+        ("a" * 10, 9), ("a" * 9, 9), ("é" * 5, 9), ("é" * 4, 9), ("€" * 3, 9), ("", 0),
+    ])
+    def test_matches_encoded_length(self, text, max_bytes):
+        assert _utf8_length_exceeds(text, max_bytes) == (len(text.encode('utf-8')) > max_bytes)
+
+
+class TestCalcClaudeTokens:
+    class FakeAnthropic:
+        instances = 0
+        requests = 0
+
+        def __init__(self, api_key):
+            TestCalcClaudeTokens.FakeAnthropic.instances += 1
+            self.messages = self
+
+        def count_tokens(self, model, system, messages):
+            TestCalcClaudeTokens.FakeAnthropic.requests += 1
+            class Response:
+                input_tokens = len(messages[0]["content"].split())
+            return Response()
+
+    @pytest.fixture(autouse=True)
+    def fake_anthropic(self, monkeypatch):
+        monkeypatch.setattr(token_handler_module, "_get_encoder", lambda model: TokenEncoderAdapter(FakeEncoder()))
+        monkeypatch.setattr(anthropic, "Anthropic", self.FakeAnthropic)
+        monkeypatch.setattr(TokenHandler, "_anth_client", None)
+        self.FakeAnthropic.instances = self.FakeAnthropic.requests = 0
+        TokenHandler.clear_cache()
+        yield
+        TokenHandler.clear_cache()
+
+    def test_client_is_reused(self):
+        assert TokenHandler().calc_claude_tokens("one two") == 2
+        assert TokenHandler().calc_claude_tokens("one two three") == 3
+        assert self.FakeAnthropic.instances == 1
+
+    def test_counts_are_cached(self):
+        assert TokenHandler().calc_claude_tokens("one two") == 2
+        assert TokenHandler().calc_claude_tokens("one two") == 2
+        assert self.FakeAnthropic.requests == 1